@@ -0,0 +1,115 @@
+"""
+Query plan and latency of the anomaly listing over a synthetic table, without and with the Anomaly indexes.
+
+    python -m benchmarks.anomaly_query --rows 2000000
+"""
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from .utils import setup_django, measure
+
+TOOLSETS_COUNT = 20
+DAYS = 90
+FEATURES_COUNT = 8
+INSERT_CHUNK_SIZE = 50000
+
+
+def populate(rows: int):
+    from django.db import connection, transaction
+    from mtehis_web.models import Toolset, AnomalyClass, Anomaly
+    from mtehis_web.array_codec import encode_array
+
+    toolset_ids = [Toolset.objects.create(name=f'bench-{i}', detector=b'').id for i in range(TOOLSETS_COUNT)]
+    label_ids = [AnomalyClass.objects.create(name=f'class-{i}').id for i in range(4)]
+
+    random = np.random.default_rng(0)
+    payload = encode_array(random.random(FEATURES_COUNT))
+    started_at = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    seconds_range = DAYS * 24 * 3600
+
+    sql = (f'INSERT INTO {Anomaly._meta.db_table} '
+           f'(toolset_id, inputs, detector_scores, classifier_scores, label_id, created_at) '
+           f'VALUES (%s, %s, %s, %s, %s, %s)')
+
+    for offset in range(0, rows, INSERT_CHUNK_SIZE):
+        count = min(INSERT_CHUNK_SIZE, rows - offset)
+        toolsets = random.choice(toolset_ids, count)
+        seconds = np.sort(random.integers(0, seconds_range, count))
+        labelled = random.random(count) < 0.1
+        labels = random.choice(label_ids, count)
+
+        params = [
+            (
+                int(toolsets[i]),
+                payload,
+                payload,
+                b'',
+                int(labels[i]) if labelled[i] else None,
+                connection.ops.adapt_datetimefield_value(started_at + timedelta(seconds=int(seconds[i]))),
+            )
+            for i in range(count)
+        ]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    return started_at
+
+
+def report(title: str, started_at: datetime):
+    from django.db import connection
+    from mtehis_web.models import Anomaly
+    from mtehis_web.exports import EXPORT_FIELDS, filter_anomalies
+
+    datetime_from = started_at + timedelta(days=DAYS // 2)
+    datetime_to = datetime_from + timedelta(days=1)
+
+    queries = {
+        'join on toolset name': Anomaly.objects.filter(toolset__name='bench-0', created_at__gte=datetime_from,
+                                                       created_at__lte=datetime_to).values(*EXPORT_FIELDS),
+        'resolved toolset id': filter_anomalies('bench-0', datetime_from, datetime_to).values(*EXPORT_FIELDS),
+        'labelled anomalies': Anomaly.objects.filter(toolset__name='bench-0', label__isnull=False)
+                                             .order_by().values('id'),
+    }
+
+    print(f'== {title}')
+    for name, queryset in queries.items():
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+
+        latency = measure(lambda: list(queryset.all()))
+        print(f'{name}: {latency * 1000:.1f} ms')
+        for step in plan:
+            print(f'    {step}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connection
+    from mtehis_web.models import Anomaly
+
+    started_at = populate(args.rows)
+
+    with connection.schema_editor() as schema_editor:
+        for index in Anomaly._meta.indexes:
+            schema_editor.remove_index(Anomaly, index)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    report('without indexes', started_at)
+
+    with connection.schema_editor() as schema_editor:
+        for index in Anomaly._meta.indexes:
+            schema_editor.add_index(Anomaly, index)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    report('with indexes', started_at)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Concurrent writers persisting detected anomalies, one process per writer, with the old default SQLite setup, the tuned
+SQLite profile and, when the MTEHIS_DB_* variables point to a reachable server, the PostgreSQL profile.
+
+Every profile runs in a fresh interpreter. The PostgreSQL run writes to the configured database and deletes its
+toolset afterwards.
+
+    python -m benchmarks.concurrent_writes --writers 8 --requests 200 --rows 20
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+from .utils import setup_django, create_toolset
+
+PROFILES = ['sqlite-default', 'sqlite-tuned', 'postgresql']
+FEATURES_COUNT = 8
+
+
+def writer(toolset_id: int, requests: int, rows: int, results):
+    from django.db import OperationalError, connection
+    from mtehis_web.anomaly_store import persist_anomalies
+
+    random = np.random.default_rng(os.getpid())
+    latencies = []
+    errors = 0
+    for _ in range(requests):
+        inputs = random.random((rows, FEATURES_COUNT))
+        started_at = time.perf_counter()
+        try:
+            persist_anomalies(toolset_id, inputs, inputs)
+        except OperationalError:
+            # "database is locked" once the busy timeout ran out
+            errors += 1
+        latencies.append(time.perf_counter() - started_at)
+
+    connection.close()
+    results.put((latencies, errors))
+
+
+def child(profile: str, writers: int, requests: int, rows: int):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+    from django.conf import settings
+
+    if profile == 'sqlite-default':
+        # The settings before the database profiles: rollback journal, a connection per request, 5 s lock wait
+        settings.SQLITE_PRAGMAS = {}
+        settings.DATABASES['default'].update(OPTIONS={}, CONN_MAX_AGE=0)
+
+    try:
+        setup_django()
+    except Exception as e:
+        print(f'{profile:>15} skipped: {e}'.splitlines()[0])
+        return
+
+    from django.db import connection
+    from mtehis_web.models import Anomaly
+
+    toolset = create_toolset('bench-writes', FEATURES_COUNT)
+    connection.close()
+
+    # Forked writers inherit the configured Django instead of setting it up again
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=writer, args=(toolset.id, requests, rows, results))
+                 for _ in range(writers)]
+    started_at = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started_at
+    for process in processes:
+        process.join()
+
+    latencies = np.concatenate([latencies for latencies, _ in outcomes]) * 1000
+    errors = sum(errors for _, errors in outcomes)
+    written = Anomaly.objects.filter(toolset_id=toolset.id).count()
+    print(f'{profile:>15} {written / elapsed:>12.0f} {np.percentile(latencies, 50):>9.1f} '
+          f'{np.percentile(latencies, 99):>9.1f} {errors:>7}')
+
+    toolset.delete()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='Persist calls per writer')
+    parser.add_argument('--rows', type=int, default=20, help='Anomalies per persist call')
+    parser.add_argument('--child', choices=PROFILES)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.writers, args.requests, args.rows)
+        return
+
+    print(f'{"profile":>15} {"rows/s":>12} {"p50, ms":>9} {"p99, ms":>9} {"errors":>7}')
+    for profile in PROFILES:
+        environment = dict(os.environ, MTEHIS_DB_PROFILE=profile.split('-')[0])
+        subprocess.run([sys.executable, '-m', 'benchmarks.concurrent_writes', '--writers', str(args.writers),
+                        '--requests', str(args.requests), '--rows', str(args.rows), '--child', profile],
+                       env=environment, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Request latency of POST /anomalies/detect against batch size and anomaly rate.
+
+Compares the legacy one INSERT per anomaly persistence with the bulk path.
+
+    python -m benchmarks.detect_anomalies
+"""
+import json
+import pickle
+from unittest import mock
+from .utils import setup_django, create_toolset, FakeDetector, measure
+
+FEATURES_COUNT = 8
+BATCH_SIZES = [100, 1000, 10000]
+ANOMALY_RATES = [0.01, 0.05, 0.2]
+
+
+def legacy_persist_detection(toolset_id, input_data, detection, batch_size=None):
+    from mtehis_web.models import Anomaly
+
+    inputs = input_data[detection.anomalies_mask]
+    detector_scores = detection.scores[detection.anomalies_mask]
+    for i in range(len(inputs)):
+        Anomaly.objects.create(
+            toolset_id=toolset_id,
+            inputs=pickle.dumps(inputs[i].tolist()),
+            detector_scores=pickle.dumps(detector_scores[i].tolist()),
+            label=None,
+        )
+    return len(inputs)
+
+
+def main():
+    setup_django()
+
+    import numpy as np
+    from django.test import Client
+    from mtehis_web.toolset_pool import ToolsetPool
+
+    create_toolset('bench', FEATURES_COUNT)
+    client = Client()
+
+    print(f'{"rows":>8} {"rate":>6} {"legacy, ms":>12} {"bulk, ms":>12} {"speedup":>8}')
+
+    for batch_size in BATCH_SIZES:
+        body = json.dumps({
+            'toolset': 'bench',
+            'data': np.random.default_rng(0).random((batch_size, FEATURES_COUNT)).tolist(),
+        })
+
+        for anomaly_rate in ANOMALY_RATES:
+            ToolsetPool.get_or_load_toolset('bench').detector = FakeDetector(anomaly_rate)
+
+            def post():
+                response = client.post('/anomalies/detect', body, content_type='application/json')
+                assert response.status_code == 200
+
+            with mock.patch('mtehis_web.views.persist_detection', legacy_persist_detection):
+                legacy = measure(post)
+            bulk = measure(post)
+
+            print(f'{batch_size:>8} {anomaly_rate:>6.2f} {legacy * 1000:>12.1f} {bulk * 1000:>12.1f} '
+                  f'{legacy / bulk:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Throughput and latency of many small concurrent predictions, unbatched and through MicroBatcher.
+
+The fake detector has a fixed cost per call and a small cost per row, like a detector whose Python and numpy call
+overhead dominates for batches of a handful of rows.
+
+    python -m benchmarks.micro_batching
+"""
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from mtehis_web.micro_batching import MicroBatcher
+
+FEATURES_COUNT = 8
+ROWS_PER_REQUEST = 4
+REQUESTS_PER_CLIENT = 200
+CLIENTS = [1, 8, 32]
+WINDOWS = [0.001, 0.005]
+CALL_OVERHEAD = 0.0005
+ROW_COST = 0.000002
+
+
+class OverheadDetector:
+    def predict_with_scores(self, data: np.ndarray):
+        time.sleep(CALL_OVERHEAD + ROW_COST * len(data))
+        return np.zeros(len(data), dtype=np.int64), np.zeros(data.shape)
+
+
+def run(predict_func, clients: int):
+    data = np.random.default_rng(0).random((ROWS_PER_REQUEST, FEATURES_COUNT))
+    latencies = []
+
+    def client():
+        for _ in range(REQUESTS_PER_CLIENT):
+            started_at = time.perf_counter()
+            predict_func(data)
+            latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for _ in range(clients):
+            executor.submit(client)
+    elapsed = time.perf_counter() - started_at
+
+    return clients * REQUESTS_PER_CLIENT / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    detector = OverheadDetector()
+    lock = threading.Lock()
+
+    def unbatched(data):
+        with lock:
+            return detector.predict_with_scores(data)
+
+    print(f'{"clients":>8} {"mode":>14} {"req/s":>10} {"p50, ms":>9} {"p99, ms":>9} {"rows/call":>10}')
+    for clients in CLIENTS:
+        throughput, p50, p99 = run(unbatched, clients)
+        print(f'{clients:>8} {"unbatched":>14} {throughput:>10.0f} {p50 * 1000:>9.2f} {p99 * 1000:>9.2f} '
+              f'{ROWS_PER_REQUEST:>10.1f}')
+
+        for window in WINDOWS:
+            batcher = MicroBatcher(unbatched, window, 10000)
+            throughput, p50, p99 = run(batcher.predict_with_scores, clients)
+            rows_per_call = ROWS_PER_REQUEST * batcher.stats['requests'] / batcher.stats['batches']
+            print(f'{clients:>8} {f"window {window * 1000:g} ms":>14} {throughput:>10.0f} {p50 * 1000:>9.2f} '
+                  f'{p99 * 1000:>9.2f} {rows_per_call:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Peak and retained RSS of one training job per dataset dtype.
+
+Every run happens in a fresh interpreter, so the peak of one run does not hide the next one.
+
+    python -m benchmarks.training_memory --rows 1000000 --features 16
+"""
+import os
+import sys
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from .utils import setup_django, create_toolset
+
+DTYPES = ['float64', 'float32']
+
+
+def current_rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def child(csv_path: str, features_count: int, dtype: str):
+    import gc
+
+    setup_django()
+
+    from django.test.utils import override_settings
+    from mtehis_web.models import TrainingJob
+    from mtehis_web.jobs import run_training_job
+
+    toolset = create_toolset('bench', features_count)
+    started_rss = current_rss_mb()
+
+    spooled_path = csv_path + '.spooled'
+    shutil.copyfile(csv_path, spooled_path)
+    job = TrainingJob.objects.create(toolset=toolset, train_file=spooled_path)
+
+    with override_settings(TRAINING_DTYPE=dtype):
+        run_training_job(job.id)
+
+    gc.collect()
+    job.refresh_from_db()
+    print(f'{dtype:>8} {job.status:>9} {started_rss:>12.0f} {peak_rss_mb():>10.0f} {current_rss_mb():>14.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--features', type=int, default=16)
+    parser.add_argument('--child', nargs=2, metavar=('CSV', 'DTYPE'))
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.features, args.child[1])
+        return
+
+    directory = tempfile.mkdtemp(prefix='mtehis-bench-')
+    csv_path = os.path.join(directory, 'train.csv')
+    data = pd.DataFrame(np.random.default_rng(0).random((args.rows, args.features)),
+                        columns=[f'f{i}' for i in range(args.features)])
+    data.insert(0, 'timestamp', np.arange(args.rows))
+    data.to_csv(csv_path, index=False)
+    del data
+
+    print(f'{"dtype":>8} {"status":>9} {"start, MB":>12} {"peak, MB":>10} {"retained, MB":>14}')
+    for dtype in DTYPES:
+        subprocess.run([sys.executable, '-m', 'benchmarks.training_memory', '--features', str(args.features),
+                        '--child', csv_path, dtype], check=True)
+
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import time
+import tempfile
+import django
+import numpy as np
+
+
+def setup_django(database_name: str = None):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+
+    from django.conf import settings
+
+    # Other database profiles benchmark against the configured database
+    if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        if database_name is None:
+            database_name = os.path.join(tempfile.mkdtemp(prefix='mtehis-bench-'), 'db.sqlite3')
+        settings.DATABASES['default']['NAME'] = database_name
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+
+    return database_name
+
+
+def create_toolset(name: str, features_count: int):
+    import pickle
+    from mtehis.model import LearningDetector
+    from mtehis_web.models import Toolset
+
+    toolset, _ = Toolset.objects.get_or_create(
+        name=name,
+        defaults={'detector': pickle.dumps(LearningDetector(features_count).get_data())},
+    )
+    return toolset
+
+
+class FakeDetector:
+    def __init__(self, anomaly_rate: float, seed: int = 0):
+        self.anomaly_rate = anomaly_rate
+        self.random = np.random.default_rng(seed)
+
+    def predict_with_scores(self, data: np.ndarray):
+        predicted = (self.random.random(len(data)) < self.anomaly_rate).astype(np.int64)
+        scores = self.random.random(data.shape)
+        return predicted, scores
+
+
+def measure(func, repeat: int = 5):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started_at)
+    return float(np.median(timings))
@@ -1,15 +1,20 @@
 from django.contrib import admin
-from .models import Toolset, AnomalyClass, AnomalyClassMapping
+from django.utils import timezone
+from .models import Toolset, AnomalyClass, AnomalyClassMapping, Anomaly
 from .forms import ToolsetForm
 
 
 class ToolsetAdmin(admin.ModelAdmin):
     form = ToolsetForm
+    list_display = ['name', 'detector_features_count', 'classifier_layer_sizes', 'detector_size', 'classifier_size',
+                    'updated_at']
+    readonly_fields = ['revision', 'updated_at', 'detector_size', 'detector_checksum', 'classifier_size',
+                       'classifier_checksum']
     fieldsets = [
         (
             None,
             {
-                'fields': ['name', 'features_count'],
+                'fields': ['name', 'features_count', 'retention_days'],
             },
         ),
         (
@@ -19,13 +24,43 @@ class ToolsetAdmin(admin.ModelAdmin):
                 'fields': ['classifier_hidden_layer_sizes'],
             },
         ),
+        (
+            'Serialized models',
+            {
+                'classes': ['collapse'],
+                'fields': ['revision', 'updated_at', ('detector_size', 'detector_checksum'),
+                           ('classifier_size', 'classifier_checksum')],
+            },
+        ),
     ]
 
+    def get_queryset(self, request):
+        # The form reads the metadata columns, so the blobs are only fetched when a detector is rebuilt
+        return super().get_queryset(request).defer('detector', 'classifier')
+
 
 class AnomalyClassMappingAdmin(admin.ModelAdmin):
     fields = ['toolset', ('index', 'anomaly_class')]
 
 
+class AnomalyAdmin(admin.ModelAdmin):
+    fields = ['toolset', 'label', 'created_at', 'labelled_at']
+    readonly_fields = ['toolset', 'created_at', 'labelled_at']
+    list_display = ['id', 'toolset', 'label', 'created_at', 'labelled_at']
+    list_filter = ['toolset', 'label']
+    list_select_related = ['toolset', 'label']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('inputs', 'detector_scores', 'classifier_scores')
+
+    def save_model(self, request, obj, form, change):
+        # Only labels assigned by hand are used to retrain classifiers
+        if 'label' in form.changed_data:
+            obj.labelled_at = timezone.now() if obj.label is not None else None
+        super().save_model(request, obj, form, change)
+
+
 admin.site.register(Toolset, ToolsetAdmin)
 admin.site.register(AnomalyClass)
 admin.site.register(AnomalyClassMapping, AnomalyClassMappingAdmin)
+admin.site.register(Anomaly, AnomalyAdmin)
@@ -0,0 +1,210 @@
+"""
+Write-behind buffer of anomaly rows.
+
+Rows are flushed by a background thread in one transaction once ``flush_rows`` are pending or the oldest pending row
+waited ``flush_interval`` seconds. Every accepted batch is appended to a journal file first (length prefixed pickles),
+journals left behind by a crashed process are replayed when the next sink starts.
+"""
+import os
+import time
+import fcntl
+import pickle
+import struct
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct('<I')
+
+
+class AnomalySink:
+
+    def __init__(self, write_func, max_rows: int, flush_rows: int, flush_interval: float,
+                 journal_directory: Optional[str] = None, journal_fsync: bool = False):
+        self.write_func = write_func
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.journal_directory = Path(journal_directory) if journal_directory else None
+        self.journal_fsync = journal_fsync
+        self.stats = {
+            'queued_rows': 0,
+            'enqueued_rows': 0,
+            'flushed_rows': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'overflows': 0,
+            'last_flush_seconds': 0.0,
+            'total_flush_seconds': 0.0,
+        }
+        self._condition = threading.Condition()
+        self._batches: list[list] = []
+        self._first_queued_at = None
+        self._retry_at = None
+        self._journal = None
+        self._segments: list = []
+        self._closed = False
+        self._thread = None
+
+        if self.journal_directory is not None:
+            self.journal_directory.mkdir(parents=True, exist_ok=True)
+            self._recover()
+
+    def put(self, rows: list) -> bool:
+        with self._condition:
+            # A full or closed buffer leaves the rows to the caller, which writes them synchronously
+            if self._closed or self.stats['queued_rows'] + len(rows) > self.max_rows:
+                self.stats['overflows'] += 1
+                return False
+
+            self._append_to_journal(rows)
+            self._batches.append(rows)
+            self.stats['queued_rows'] += len(rows)
+            self.stats['enqueued_rows'] += len(rows)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='anomaly-sink', daemon=True)
+                self._thread.start()
+            # The flusher waits without a timeout while the buffer is empty, the first rows start the interval
+            if self._first_queued_at is None:
+                self._first_queued_at = time.monotonic()
+                self._condition.notify()
+            elif self.stats['queued_rows'] >= self.flush_rows:
+                self._condition.notify()
+        return True
+
+    def get_stats(self) -> dict:
+        with self._condition:
+            return dict(self.stats)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+        # Rows a failing flusher gave up on get a last synchronous attempt
+        self._flush()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed:
+                        now = time.monotonic()
+                        if self._retry_at is not None and now < self._retry_at:
+                            timeout = self._retry_at - now
+                        elif self.stats['queued_rows'] >= self.flush_rows:
+                            break
+                        elif self._first_queued_at is not None:
+                            timeout = self._first_queued_at + self.flush_interval - now
+                            if timeout <= 0:
+                                break
+                        else:
+                            timeout = None
+                        self._condition.wait(timeout)
+                    closed = self._closed
+
+                flushed = self._flush()
+                if closed:
+                    return
+                with self._condition:
+                    # Failed rows are kept and retried after the interval
+                    self._retry_at = None if flushed else time.monotonic() + self.flush_interval
+        finally:
+            connection.close()
+
+    def _flush(self) -> bool:
+        with self._condition:
+            batches, self._batches = self._batches, []
+            segments, self._segments = self._segments, []
+            if self._journal is not None:
+                segments.append(self._journal)
+                self._journal = None
+            self._first_queued_at = None
+
+        if not batches:
+            self._remove_segments(segments)
+            return True
+
+        rows = [row for batch in batches for row in batch]
+        started_at = time.perf_counter()
+        try:
+            connection.close_if_unusable_or_obsolete()
+            self.write_func(rows)
+        except Exception:
+            logger.exception('Failed to flush %d anomalies', len(rows))
+            with self._condition:
+                self._batches[:0] = batches
+                self._segments[:0] = segments
+                if self._first_queued_at is None:
+                    self._first_queued_at = time.monotonic()
+                self.stats['failed_flushes'] += 1
+            return False
+
+        elapsed = time.perf_counter() - started_at
+        self._remove_segments(segments)
+        with self._condition:
+            self.stats['queued_rows'] -= len(rows)
+            self.stats['flushed_rows'] += len(rows)
+            self.stats['flushes'] += 1
+            self.stats['last_flush_seconds'] = elapsed
+            self.stats['total_flush_seconds'] += elapsed
+        return True
+
+    def _append_to_journal(self, rows: list):
+        if self.journal_directory is None:
+            return
+
+        if self._journal is None:
+            path = self.journal_directory / f'{os.getpid()}-{time.time_ns()}.journal'
+            self._journal = open(path, 'ab')
+            # The lock tells recovering processes that this journal belongs to a live process
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        record = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(_RECORD_HEADER.pack(len(record)) + record)
+        self._journal.flush()
+        if self.journal_fsync:
+            os.fsync(self._journal.fileno())
+
+    @staticmethod
+    def _remove_segments(segments: list):
+        for segment in segments:
+            os.unlink(segment.name)
+            segment.close()
+
+    def _recover(self):
+        for path in sorted(self.journal_directory.glob('*.journal')):
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                rows = []
+                while True:
+                    header = f.read(_RECORD_HEADER.size)
+                    if len(header) < _RECORD_HEADER.size:
+                        break
+                    size, = _RECORD_HEADER.unpack(header)
+                    record = f.read(size)
+                    # A record cut short by the crash was never acknowledged to its request
+                    if len(record) < size:
+                        break
+                    rows.extend(pickle.loads(record))
+
+                if rows:
+                    try:
+                        self.write_func(rows)
+                    except Exception:
+                        logger.exception('Failed to replay %d anomalies from %s', len(rows), path)
+                        continue
+                    logger.warning('Replayed %d anomalies from %s', len(rows), path)
+                os.unlink(path)
@@ -0,0 +1,164 @@
+import threading
+from datetime import datetime
+from typing import Optional
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Toolset, Anomaly
+from .array_codec import decode_row_groups
+from .exports import get_export_chunk_size
+from .retention import get_rollup_delay
+
+STATS_FIELDS = ['inputs', 'detector_scores']
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_percentiles() -> list:
+    return getattr(settings, 'ANOMALY_STATS_PERCENTILES', [50, 90, 99])
+
+
+def get_sample_size() -> int:
+    return getattr(settings, 'ANOMALY_STATS_SAMPLE_SIZE', 100000)
+
+
+def get_cache_size() -> int:
+    return getattr(settings, 'ANOMALY_STATS_CACHE_SIZE', 128)
+
+
+class FeatureStats:
+
+    def __init__(self, sample_size: int):
+        self.sample_size = sample_size
+        self.count = 0
+        self.skipped = 0
+        self.score_sum = None
+        self.score_min = None
+        self.score_max = None
+        self.sample = None
+        self.sample_keys = None
+
+    def add(self, values: np.ndarray, keys: np.ndarray):
+        values = values.reshape(len(values), -1).astype(np.float64)
+        # Rows of another features count cannot be aggregated per feature with the first ones
+        if self.score_sum is not None and values.shape[1] != self.score_sum.shape[0]:
+            self.skipped += len(values)
+            return
+
+        if self.score_sum is None:
+            self.score_sum = values.sum(axis=0)
+            self.score_min = values.min(axis=0)
+            self.score_max = values.max(axis=0)
+            self.sample, self.sample_keys = values[:0], keys[:0]
+        else:
+            self.score_sum += values.sum(axis=0)
+            np.minimum(self.score_min, values.min(axis=0), out=self.score_min)
+            np.maximum(self.score_max, values.max(axis=0), out=self.score_max)
+        self.count += len(values)
+
+        # Rows with the smallest random keys form a uniform sample of bounded size for the percentiles
+        sample = np.concatenate([self.sample, values])
+        sample_keys = np.concatenate([self.sample_keys, keys])
+        if len(sample) > self.sample_size:
+            kept = np.argpartition(sample_keys, self.sample_size)[:self.sample_size]
+            sample, sample_keys = sample[kept], sample_keys[kept]
+        self.sample, self.sample_keys = sample, sample_keys
+
+    def to_dict(self, percentiles: list) -> Optional[dict]:
+        if self.count == 0:
+            return None
+
+        return {
+            'mean': (self.score_sum / self.count).tolist(),
+            'min': self.score_min.tolist(),
+            'max': self.score_max.tolist(),
+            'percentiles': {
+                str(percentile): values.tolist()
+                for percentile, values in zip(percentiles, np.percentile(self.sample, percentiles, axis=0))
+            },
+            'sampled': len(self.sample),
+            'skipped': self.skipped,
+        }
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'Invalid datetime: {value}')
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def compute_stats(toolset_id: int, datetime_from: datetime = None, datetime_to: datetime = None) -> dict:
+    anomalies = Anomaly.objects.filter(toolset_id=toolset_id)
+    if datetime_from is not None:
+        anomalies = anomalies.filter(created_at__gte=datetime_from)
+    if datetime_to is not None:
+        anomalies = anomalies.filter(created_at__lte=datetime_to)
+
+    labels = {
+        item['label__name']: item['count']
+        for item in anomalies.order_by().values('label__name').annotate(count=Count('id'))
+    }
+
+    sample_size = get_sample_size()
+    stats = {field: FeatureStats(sample_size) for field in STATS_FIELDS}
+    random = np.random.default_rng()
+    anomalies = anomalies.order_by('-created_at', '-id')
+    chunk_size = get_export_chunk_size()
+    last = None
+    while True:
+        chunk = anomalies
+        if last is not None:
+            chunk = chunk.filter(Q(created_at__lt=last[0]) | Q(created_at=last[0], id__lt=last[1]))
+        rows = list(chunk.values_list('id', 'created_at', *STATS_FIELDS)[:chunk_size])
+        if not rows:
+            break
+        last = rows[-1][1], rows[-1][0]
+
+        keys = random.random(len(rows))
+        for i, field in enumerate(STATS_FIELDS):
+            for selected, values in decode_row_groups([row[2 + i] for row in rows]):
+                stats[field].add(values, keys[selected])
+
+    percentiles = get_percentiles()
+    return {
+        'count': sum(labels.values()),
+        'labels': labels,
+        **{field: field_stats.to_dict(percentiles) for field, field_stats in stats.items()},
+    }
+
+
+def get_anomaly_stats(toolset_name: str, datetime_from: str = None, datetime_to: str = None) -> dict:
+    toolset = Toolset.objects.only('id').get(name=toolset_name)
+    datetime_from, datetime_to = _parse_datetime(datetime_from), _parse_datetime(datetime_to)
+
+    # Anomalies of a window that ended before the write-behind delay do not change anymore, except for labels assigned
+    # by hand. Those set labelled_at, which the key follows. Rows removed by retention are not noticed. The stats only
+    # depend on stored anomalies, so retraining the toolset does not change them.
+    closed = datetime_to is not None and datetime_to <= timezone.now() - get_rollup_delay()
+    key = None
+    if closed:
+        labelled = Anomaly.objects.filter(toolset_id=toolset.id, labelled_at__isnull=False).aggregate(
+            last=Max('labelled_at'), count=Count('labelled_at'))
+        key = (toolset.id, datetime_from, datetime_to, labelled['last'], labelled['count'])
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+                return _cache[key]
+
+    stats = compute_stats(toolset.id, datetime_from, datetime_to)
+
+    if closed:
+        with _cache_lock:
+            _cache[key] = stats
+            while len(_cache) > get_cache_size():
+                _cache.popitem(last=False)
+
+    return stats
@@ -0,0 +1,90 @@
+import atexit
+import threading
+import numpy as np
+from typing import Optional
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Anomaly
+from .array_codec import encode_rows
+from .anomaly_sink import AnomalySink
+from . import metrics
+
+ROW_FIELDS = ['toolset_id', 'inputs', 'detector_scores', 'classifier_scores', 'label_id', 'created_at']
+
+_sink: Optional[AnomalySink] = None
+_sink_lock = threading.Lock()
+
+
+def get_bulk_create_batch_size() -> int:
+    return getattr(settings, 'ANOMALY_BULK_CREATE_BATCH_SIZE', 500)
+
+
+def get_anomaly_sink() -> Optional[AnomalySink]:
+    global _sink
+
+    if not getattr(settings, 'ANOMALY_WRITE_BEHIND', False):
+        return None
+
+    with _sink_lock:
+        if _sink is None:
+            _sink = AnomalySink(write_rows,
+                                max_rows=getattr(settings, 'ANOMALY_WRITE_BEHIND_MAX_ROWS', 100000),
+                                flush_rows=getattr(settings, 'ANOMALY_WRITE_BEHIND_FLUSH_ROWS', 5000),
+                                flush_interval=getattr(settings, 'ANOMALY_WRITE_BEHIND_FLUSH_INTERVAL', 1),
+                                journal_directory=getattr(settings, 'ANOMALY_WRITE_BEHIND_JOURNAL_DIR', None),
+                                journal_fsync=getattr(settings, 'ANOMALY_WRITE_BEHIND_JOURNAL_FSYNC', False))
+            atexit.register(_sink.close)
+        return _sink
+
+
+def collect_sink_metrics():
+    sink = _sink
+    if sink is None:
+        return
+    for stat, value in sink.get_stats().items():
+        metrics.SINK_STATS.set(value, stat=stat)
+
+
+metrics.registry.collectors.append(collect_sink_metrics)
+
+
+def write_rows(rows: list[tuple], batch_size: int = None):
+    anomalies = [Anomaly(**dict(zip(ROW_FIELDS, row))) for row in rows]
+    with transaction.atomic():
+        Anomaly.objects.bulk_create(anomalies, batch_size=batch_size or get_bulk_create_batch_size())
+
+
+def persist_anomalies(toolset_id: int, inputs: np.ndarray, detector_scores: np.ndarray,
+                      classifier_scores: np.ndarray = None, labels: list = None, batch_size: int = None):
+    anomalies_count = len(inputs)
+    if anomalies_count == 0:
+        return 0
+
+    encoded_classifier_scores = encode_rows(classifier_scores) if classifier_scores is not None else None
+    # Rows keep the detection time even when they are written later
+    created_at = timezone.now()
+
+    rows = [
+        (
+            toolset_id,
+            row_inputs,
+            row_detector_scores,
+            encoded_classifier_scores[i] if encoded_classifier_scores is not None else b'',
+            labels[i] if labels is not None else None,
+            created_at,
+        )
+        for i, (row_inputs, row_detector_scores) in enumerate(zip(encode_rows(inputs), encode_rows(detector_scores)))
+    ]
+
+    sink = get_anomaly_sink()
+    if sink is None or not sink.put(rows):
+        write_rows(rows, batch_size)
+
+    return anomalies_count
+
+
+def persist_detection(toolset_id: int, input_data: np.ndarray, detection, batch_size: int = None):
+    anomalies_mask = detection.anomalies_mask
+    return persist_anomalies(toolset_id, input_data[anomalies_mask], detection.scores[anomalies_mask],
+                             detection.classifier_scores, detection.labels, batch_size)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MtehisWebConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mtehis_web"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,114 @@
+"""
+Compact binary encoding of numeric arrays stored in BinaryFields.
+
+Layout (little-endian): magic ``MTA``, format version, dtype char, number of dimensions, one uint32 per dimension,
+zero padding up to an 8 byte boundary, raw array buffer. Anything without the magic prefix is a legacy
+``pickle.dumps(list)`` payload.
+"""
+import pickle
+import struct
+from typing import Optional
+import numpy as np
+from django.conf import settings
+
+MAGIC = b'MTA'
+VERSION = 1
+
+_HEADER = struct.Struct('<3sBcB')
+_ALIGNMENT = 8
+_SUPPORTED_DTYPES = {np.dtype(dtype).char: np.dtype(dtype).newbyteorder('<')
+                     for dtype in (np.float32, np.float64, np.int8, np.int32, np.int64)}
+
+
+def get_default_dtype() -> np.dtype:
+    return np.dtype(getattr(settings, 'ANOMALY_ARRAY_DTYPE', 'float64'))
+
+
+def _resolve_dtype(dtype) -> np.dtype:
+    dtype = get_default_dtype() if dtype is None else np.dtype(dtype)
+    if dtype.char not in _SUPPORTED_DTYPES:
+        raise ValueError(f'Unsupported array dtype: {dtype}')
+    return _SUPPORTED_DTYPES[dtype.char]
+
+
+def _encode_header(dtype: np.dtype, shape: tuple) -> bytes:
+    header = _HEADER.pack(MAGIC, VERSION, dtype.char.encode(), len(shape)) + struct.pack(f'<{len(shape)}I', *shape)
+    return header + b'\0' * (-len(header) % _ALIGNMENT)
+
+
+def is_encoded(data) -> bool:
+    return data is not None and len(data) >= _HEADER.size and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def encode_array(values, dtype=None) -> bytes:
+    dtype = _resolve_dtype(dtype)
+    array = np.ascontiguousarray(values, dtype=dtype)
+    return _encode_header(dtype, array.shape) + array.tobytes()
+
+
+def encode_rows(matrix: np.ndarray, dtype=None) -> list[bytes]:
+    dtype = _resolve_dtype(dtype)
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    if len(matrix) == 0:
+        return []
+
+    # Every row has the same shape, so the header is built once
+    header = _encode_header(dtype, matrix.shape[1:])
+    return [header + row.tobytes() for row in matrix]
+
+
+def _header_size(data) -> int:
+    ndim = data[_HEADER.size - 1]
+    size = _HEADER.size + 4 * ndim
+    return size + (-size % _ALIGNMENT)
+
+
+def decode_rows(values: list) -> np.ndarray:
+    if len(values) == 0:
+        return np.empty((0, 0))
+
+    first = values[0]
+    if is_encoded(first):
+        header_size = _header_size(first)
+        header = bytes(first[:header_size])
+        # Rows sharing one header are joined and decoded by a single frombuffer call
+        if all(bytes(value[:header_size]) == header for value in values):
+            row = decode_array(first)
+            payload = b''.join(bytes(value[header_size:]) for value in values)
+            return np.frombuffer(payload, dtype=row.dtype).reshape((len(values), *row.shape))
+
+    return np.stack([decode_array(value) for value in values])
+
+
+def decode_row_groups(values: list):
+    # Rows of one features count share the encoded length and are decoded together, empty values are skipped
+    lengths = np.array([len(value) if value is not None else 0 for value in values])
+    for length in np.unique(lengths[lengths > 0]):
+        selected = np.flatnonzero(lengths == length)
+        yield selected, decode_rows([values[i] for i in selected])
+
+
+def decode_array(data) -> Optional[np.ndarray]:
+    if data is None or len(data) == 0:
+        return None
+
+    if not is_encoded(data):
+        return np.asarray(pickle.loads(data), dtype=np.float64)
+
+    _, version, dtype_char, ndim = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'Unsupported array encoding version: {version}')
+    dtype = _SUPPORTED_DTYPES.get(dtype_char.decode('latin-1'))
+    if dtype is None:
+        raise ValueError(f'Unsupported array dtype: {dtype_char!r}')
+
+    offset = _header_size(data)
+    if len(data) < offset:
+        raise ValueError('Encoded array header is truncated')
+    shape = struct.unpack_from(f'<{ndim}I', data, _HEADER.size)
+    if len(data) - offset != dtype.itemsize * int(np.prod(shape, dtype=np.int64)):
+        raise ValueError(f'Encoded array size does not match its shape {shape}')
+
+    # Zero-copy view on the stored buffer
+    array = np.frombuffer(data, dtype=dtype, offset=offset)
+    return array.reshape(shape)
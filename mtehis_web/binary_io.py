@@ -0,0 +1,86 @@
+import io
+import numpy as np
+from typing import Optional
+from .array_codec import encode_array, decode_array, is_encoded
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARRAY_CONTENT_TYPE = 'application/vnd.mtehis.array'
+NPY_CONTENT_TYPE = 'application/x-npy'
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+BINARY_CONTENT_TYPES = [ARRAY_CONTENT_TYPE, NPY_CONTENT_TYPE, ARROW_CONTENT_TYPE]
+INPUT_DTYPES = [np.dtype(np.float32), np.dtype(np.float64)]
+
+
+def _decode_npy(body: bytes) -> np.ndarray:
+    stream = io.BytesIO(body)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+
+    if dtype not in INPUT_DTYPES:
+        raise ValueError(f'Unsupported array dtype: {dtype}')
+
+    # The array is a view on the request body right after the header
+    array = np.frombuffer(body, dtype=dtype, offset=stream.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def _decode_arrow(body: bytes) -> np.ndarray:
+    if pa is None:
+        raise ValueError('pyarrow must be installed to accept Arrow input')
+
+    table = pa.ipc.open_stream(body).read_all()
+    return np.column_stack([column.to_numpy() for column in table.columns])
+
+
+def decode_request_array(content_type: str, body: bytes) -> np.ndarray:
+    if content_type == NPY_CONTENT_TYPE:
+        array = _decode_npy(body)
+    elif content_type == ARROW_CONTENT_TYPE:
+        array = _decode_arrow(body)
+    else:
+        if not is_encoded(body):
+            raise ValueError('Request body is not an encoded array')
+        array = decode_array(body)
+
+    if array.dtype not in INPUT_DTYPES:
+        raise ValueError(f'Unsupported array dtype: {array.dtype}')
+    if array.ndim != 2:
+        raise ValueError('Input data must be a two-dimensional array')
+    return array
+
+
+def encode_response_array(content_type: str, array: np.ndarray) -> bytes:
+    if content_type == NPY_CONTENT_TYPE:
+        stream = io.BytesIO()
+        np.lib.format.write_array(stream, np.ascontiguousarray(array), allow_pickle=False)
+        return stream.getvalue()
+
+    if content_type == ARROW_CONTENT_TYPE:
+        if pa is None:
+            raise ValueError('pyarrow must be installed to return Arrow output')
+        table = pa.table({'result': array})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    return encode_array(array, dtype=array.dtype)
+
+
+def get_accepted_content_type(accept: str) -> Optional[str]:
+    for media_range in accept.split(','):
+        media_type = media_range.split(';')[0].strip()
+        if media_type in BINARY_CONTENT_TYPES:
+            # Checked before the request is processed, an encoding failure would come after anomalies were persisted
+            if media_type == ARROW_CONTENT_TYPE and pa is None:
+                raise ValueError('pyarrow must be installed to return Arrow output')
+            return media_type
+    return None
@@ -0,0 +1,170 @@
+"""
+Storage of serialized detector and classifier blobs.
+
+Stored values start with magic ``MTB``, format version, compression codec, location (inline or file) and the SHA-256
+of the uncompressed pickle. Inline values are followed by the (compressed) pickle, file values are only a reference:
+the pickle lives in ``TOOLSET_BLOB_DIR`` under its checksum, so identical content is written once. Anything without
+the magic prefix is a plain pickle, which is also what is stored when neither compression nor a directory is set.
+"""
+import os
+import time
+import pickle
+import struct
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Optional
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'MTB'
+VERSION = 1
+
+_HEADER = struct.Struct('<3sBcc32s')
+_INLINE = b'i'
+_FILE = b'f'
+_CODECS = {None: b'n', 'zstd': b'z', 'lz4': b'l'}
+_SUFFIXES = {b'n': '', b'z': '.zst', b'l': '.lz4'}
+
+
+def get_compression() -> Optional[str]:
+    compression = getattr(settings, 'TOOLSET_BLOB_COMPRESSION', None)
+    if compression not in _CODECS:
+        raise ValueError(f'Unsupported blob compression: {compression}')
+    return compression
+
+
+def get_directory() -> Optional[Path]:
+    directory = getattr(settings, 'TOOLSET_BLOB_DIR', None)
+    return Path(directory) if directory else None
+
+
+def serialize(model) -> bytes:
+    return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def is_stored(value) -> bool:
+    return value is not None and len(value) >= _HEADER.size and bytes(value[:len(MAGIC)]) == MAGIC
+
+
+def needs_store(value) -> bool:
+    # Plain pickles assigned directly are converted once compression or the directory is enabled
+    return bool(value) and not is_stored(value) and (get_compression() is not None or get_directory() is not None)
+
+
+def get_checksum(value) -> str:
+    if not value:
+        return ''
+    if is_stored(value):
+        return _HEADER.unpack_from(value)[4].hex()
+    return hashlib.sha256(value).hexdigest()
+
+
+def _compress(codec: bytes, data: bytes) -> bytes:
+    if codec == b'z':
+        if zstandard is None:
+            raise ImportError('zstandard must be installed to use zstd blob compression')
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == b'l':
+        if lz4 is None:
+            raise ImportError('lz4 must be installed to use lz4 blob compression')
+        return lz4.frame.compress(data)
+    return data
+
+
+def _decompress(codec: bytes, data) -> bytes:
+    if codec == b'z':
+        if zstandard is None:
+            raise ImportError('zstandard must be installed to read zstd compressed blobs')
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == b'l':
+        if lz4 is None:
+            raise ImportError('lz4 must be installed to read lz4 compressed blobs')
+        return lz4.frame.decompress(data)
+    return bytes(data)
+
+
+def _get_file_path(directory: Path, checksum: str, codec: bytes) -> Path:
+    return directory / checksum[:2] / f'{checksum}{_SUFFIXES[codec]}'
+
+
+def _write_file(path: Path, data: bytes):
+    # Content addressed, so an existing file already holds these bytes
+    if path.exists():
+        return
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def store(data: bytes, checksum: str = None) -> bytes:
+    compression = get_compression()
+    directory = get_directory()
+    if compression is None and directory is None:
+        return data
+
+    checksum = checksum or get_checksum(data)
+    codec = _CODECS[compression]
+    payload = _compress(codec, data)
+
+    if directory is None:
+        return _HEADER.pack(MAGIC, VERSION, codec, _INLINE, bytes.fromhex(checksum)) + payload
+
+    _write_file(_get_file_path(directory, checksum, codec), payload)
+    return _HEADER.pack(MAGIC, VERSION, codec, _FILE, bytes.fromhex(checksum))
+
+
+def load(value) -> bytes:
+    if not value:
+        return b''
+    if not is_stored(value):
+        return bytes(value)
+
+    _, version, codec, location, digest = _HEADER.unpack_from(value)
+    if version != VERSION:
+        raise ValueError(f'Unsupported blob storage version: {version}')
+
+    if location == _INLINE:
+        return _decompress(codec, memoryview(value)[_HEADER.size:])
+
+    directory = get_directory()
+    if directory is None:
+        raise ValueError('TOOLSET_BLOB_DIR must be set to read blobs stored in files')
+    return _decompress(codec, _get_file_path(directory, digest.hex(), codec).read_bytes())
+
+
+def loads(value):
+    data = load(value)
+    return pickle.loads(data) if data else None
+
+
+def remove_unreferenced(checksums: set[str], min_age: float) -> int:
+    directory = get_directory()
+    if directory is None or not directory.exists():
+        return 0
+
+    removed = 0
+    now = time.time()
+    for path in directory.glob('*/*'):
+        # Files of blobs being saved are written before their row is committed
+        if path.name.split('.')[0] in checksums or now - path.stat().st_mtime < min_age:
+            continue
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed
@@ -0,0 +1,92 @@
+import copy
+import logging
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from .models import Toolset, Anomaly, AnomalyClassMapping
+from .array_codec import decode_rows
+from .toolset_pool import ToolsetPool, ActiveToolset
+
+logger = logging.getLogger(__name__)
+
+
+def get_retraining_batch_size() -> int:
+    return getattr(settings, 'CLASSIFIER_RETRAINING_BATCH_SIZE', 1000)
+
+
+def retrain_classifier(toolset_name: str, batch_size: int = None) -> int:
+    batch_size = batch_size or get_retraining_batch_size()
+    toolset = Toolset.objects.only('id', 'name', 'classifier_watermark', 'classifier_watermark_id').get(
+        name=toolset_name)
+    active_toolset = ToolsetPool.get_or_load_toolset(toolset_name)
+    if active_toolset.classifier is None:
+        raise ValueError(f'Toolset {toolset_name} has no classifier')
+
+    # The retrained classifier replaces the one of the pooled toolset, so it must not be evicted in the meantime
+    with active_toolset.pinned():
+        return _retrain(toolset, active_toolset, batch_size)
+
+
+def _retrain(toolset: Toolset, active_toolset: ActiveToolset, batch_size: int) -> int:
+    toolset_name = toolset.name
+
+    # Classifier outputs are mapping indices, so the labels are translated back to them
+    class_indices = dict(
+        AnomalyClassMapping.objects.filter(toolset_id=toolset.id, anomaly_class__isnull=False)
+        .values_list('anomaly_class_id', 'index')
+    )
+    if not class_indices:
+        raise ValueError(f'Toolset {toolset_name} has no anomaly class mapping')
+    classes = np.array(sorted(class_indices.values()))
+
+    # Detection keeps using the loaded classifier while a copy learns
+    classifier = copy.deepcopy(active_toolset.classifier)
+    if hasattr(classifier, 'classes_'):
+        known_classes = set(classifier.classes_.tolist())
+        unknown_classes = set(classes.tolist()) - known_classes
+        if unknown_classes:
+            logger.warning('Classifier of %s cannot learn new classes %s incrementally, their anomalies are skipped',
+                           toolset_name, sorted(unknown_classes))
+    else:
+        known_classes = set(classes.tolist())
+
+    anomalies = (Anomaly.objects
+                 .filter(toolset_id=toolset.id, labelled_at__isnull=False, label_id__in=class_indices.keys())
+                 .order_by('labelled_at', 'id'))
+    watermark, watermark_id = toolset.classifier_watermark, toolset.classifier_watermark_id
+    learned = 0
+
+    while True:
+        batch = anomalies
+        if watermark is not None:
+            batch = batch.filter(Q(labelled_at__gt=watermark) | Q(labelled_at=watermark, id__gt=watermark_id))
+        rows = list(batch.values_list('id', 'labelled_at', 'label_id', 'inputs')[:batch_size])
+        if not rows:
+            break
+
+        watermark_id, watermark = rows[-1][0], rows[-1][1]
+
+        targets = np.array([class_indices[row[2]] for row in rows])
+        known = np.isin(targets, list(known_classes))
+        if not known.any():
+            continue
+        inputs = decode_rows([row[3] for row in rows])[known]
+
+        if hasattr(classifier, 'classes_'):
+            classifier.partial_fit(inputs, targets[known])
+        else:
+            classifier.partial_fit(inputs, targets[known], classes=classes)
+        learned += int(known.sum())
+
+    if watermark is None or (watermark == toolset.classifier_watermark
+                             and watermark_id == toolset.classifier_watermark_id):
+        return learned
+
+    active_toolset.classifier = classifier
+    with transaction.atomic():
+        active_toolset.save()
+        Toolset.objects.filter(id=toolset.id).update(classifier_watermark=watermark,
+                                                     classifier_watermark_id=watermark_id)
+
+    return learned
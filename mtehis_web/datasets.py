@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+from streamad.util import CustomDS
+
+# CustomDS trains on every other column, id included, in sorted name order
+NON_FEATURE_COLUMNS = ['label', 'timestamp']
+
+
+def prepare_df(df: pd.DataFrame):
+    if 'timestamp' in df.columns:
+        df.set_index('timestamp')
+        df.sort_values('timestamp')
+    elif 'id' in df.columns:
+        df.set_index('id')
+    return df
+
+
+def read_dataset(path: str, dtype: str = None) -> Optional[CustomDS]:
+    if not path:
+        return None
+
+    if dtype is not None:
+        # Feature columns are parsed straight into the requested type instead of float64 followed by a cast
+        columns = pd.read_csv(path, nrows=0).columns
+        dtype = {column: dtype for column in get_feature_columns(columns)}
+
+    # noinspection PyTypeChecker
+    return CustomDS(prepare_df(pd.read_csv(path, dtype=dtype)))
+
+
+def get_feature_columns(columns) -> list[str]:
+    # Same selection and order as CustomDS, so detection gets the features the detector was trained on
+    return list(np.setdiff1d(columns, NON_FEATURE_COLUMNS))
+
+
+def get_features(df: pd.DataFrame) -> np.ndarray:
+    return df[get_feature_columns(df.columns)].to_numpy(np.float64)
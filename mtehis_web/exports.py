@@ -0,0 +1,249 @@
+import csv
+import json
+import base64
+import itertools
+import numpy as np
+from datetime import datetime
+from typing import Optional
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Min, Q, QuerySet
+from django.db.models.functions import Length
+from django.http import StreamingHttpResponse
+from .models import Toolset, Anomaly
+from .array_codec import decode_array
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_FIELDS = ['id', 'toolset_id', 'inputs', 'detector_scores', 'classifier_scores', 'label_id', 'created_at']
+ARRAY_FIELDS = ['inputs', 'detector_scores', 'classifier_scores']
+
+STREAMING_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+COLUMNAR_FORMATS = ['parquet', 'arrow']
+COLUMNAR_FIELDS = ['id', 'toolset_id', 'created_at', 'label__name', *ARRAY_FIELDS]
+COLUMN_PREFIXES = {
+    'inputs': 'input',
+    'detector_scores': 'detector_score',
+    'classifier_scores': 'classifier_score',
+}
+
+
+def get_export_chunk_size() -> int:
+    return getattr(settings, 'ANOMALY_EXPORT_CHUNK_SIZE', 2000)
+
+
+def get_page_max_limit() -> int:
+    return getattr(settings, 'ANOMALY_PAGE_MAX_LIMIT', 10000)
+
+
+def get_row_group_size() -> int:
+    return getattr(settings, 'ANOMALY_EXPORT_ROW_GROUP_SIZE', 50000)
+
+
+def filter_anomalies(toolset_name: str, datetime_from: str = None, datetime_to: str = None) -> QuerySet:
+    # Resolving the name once lets the (toolset, created_at) index serve the query without a join
+    toolset_id = Toolset.objects.filter(name=toolset_name).values_list('id', flat=True).first()
+    if toolset_id is None:
+        return Anomaly.objects.none()
+
+    query_filter = {'toolset_id': toolset_id}
+    if datetime_from is not None:
+        query_filter['created_at__gte'] = datetime_from
+    if datetime_to is not None:
+        query_filter['created_at__lte'] = datetime_to
+
+    # id breaks ties between anomalies created in the same instant, which keyset pagination relies on
+    return Anomaly.objects.filter(**query_filter).order_by('-created_at', '-id')
+
+
+def decode_anomaly(item: dict) -> dict:
+    for field in ARRAY_FIELDS:
+        array = decode_array(item[field])
+        item[field] = array.tolist() if array is not None else None
+    return item
+
+
+def encode_cursor(item: dict) -> str:
+    value = item['created_at'].isoformat() + '|' + str(item['id'])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, anomaly_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(anomaly_id)
+    except ValueError:
+        raise ValueError('Invalid cursor')
+
+
+def paginate_anomalies(anomalies: QuerySet, limit: int, cursor: str = None) -> tuple[list[dict], Optional[str]]:
+    if limit < 1 or limit > get_page_max_limit():
+        raise ValueError(f'Limit must be between 1 and {get_page_max_limit()}')
+
+    if cursor:
+        created_at, anomaly_id = decode_cursor(cursor)
+        anomalies = anomalies.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=anomaly_id))
+
+    # One extra row tells whether there is a next page without a COUNT query
+    items = list(anomalies.values(*EXPORT_FIELDS)[:limit + 1])
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+
+    return [decode_anomaly(item) for item in items[:limit]], next_cursor
+
+
+def _iterate_anomalies(anomalies: QuerySet):
+    for item in anomalies.values(*EXPORT_FIELDS).iterator(chunk_size=get_export_chunk_size()):
+        yield decode_anomaly(item)
+
+
+def _stream_ndjson(anomalies: QuerySet):
+    for item in _iterate_anomalies(anomalies):
+        yield json.dumps(item, cls=DjangoJSONEncoder) + '\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _stream_csv(anomalies: QuerySet):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for item in _iterate_anomalies(anomalies):
+        for field in ARRAY_FIELDS:
+            item[field] = json.dumps(item[field]) if item[field] is not None else ''
+        item['created_at'] = item['created_at'].isoformat()
+        yield writer.writerow([item[field] for field in EXPORT_FIELDS])
+
+
+class _BufferSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _columnar_layout(anomalies: QuerySet) -> list[tuple]:
+    # Rows of one features count and dtype share the encoded length, so one sample per length finds the widest row
+    # and a type every row fits in. Narrower rows are padded with nulls.
+    layout = []
+    for field, prefix in COLUMN_PREFIXES.items():
+        sample_ids = (anomalies.exclude(**{field: b''}).order_by().annotate(length=Length(field))
+                      .values('length').annotate(sample_id=Min('id')).values_list('sample_id', flat=True))
+        arrays = [decode_array(value) for value in
+                  Anomaly.objects.filter(id__in=list(sample_ids)).values_list(field, flat=True)]
+        if arrays:
+            layout.append((field, prefix, max(array.size for array in arrays),
+                           np.result_type(*[array.dtype for array in arrays])))
+    return layout
+
+
+def _columnar_schema(layout: list[tuple]):
+    fields = [
+        pa.field('id', pa.int64()),
+        pa.field('toolset_id', pa.int64()),
+        pa.field('created_at', pa.timestamp('us', tz='UTC')),
+        pa.field('label', pa.string()),
+    ]
+    for _, prefix, width, dtype in layout:
+        fields += [pa.field(f'{prefix}_{i}', pa.from_numpy_dtype(dtype)) for i in range(width)]
+    return pa.schema(fields)
+
+
+def _columnar_batch(items: list[dict], layout: list[tuple], schema):
+    columns = [
+        pa.array([item['id'] for item in items], pa.int64()),
+        pa.array([item['toolset_id'] for item in items], pa.int64()),
+        pa.array([item['created_at'] for item in items], pa.timestamp('us', tz='UTC')),
+        pa.array([item['label__name'] for item in items], pa.string()),
+    ]
+
+    for field, _, width, dtype in layout:
+        matrix = np.zeros((len(items), width), dtype=dtype)
+        missing = np.ones((len(items), width), dtype=bool)
+        for row, item in enumerate(items):
+            array = decode_array(item[field])
+            # Rows wider than the layout were created after it was read and are left null
+            if array is not None and array.size <= width:
+                matrix[row, :array.size] = array.reshape(-1)
+                missing[row, :array.size] = False
+        columns += [pa.array(matrix[:, i], mask=missing[:, i]) for i in range(width)]
+
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def _stream_columnar(anomalies: QuerySet, export_format: str):
+    layout = _columnar_layout(anomalies)
+    schema = _columnar_schema(layout)
+    row_group_size = get_row_group_size()
+
+    sink = _BufferSink()
+    output = pa.PythonFile(sink, mode='w')
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(output, schema)
+    else:
+        writer = pa.ipc.new_stream(output, schema)
+
+    items_iterator = anomalies.values(*COLUMNAR_FIELDS).iterator(chunk_size=get_export_chunk_size())
+    while True:
+        items = list(itertools.islice(items_iterator, row_group_size))
+        if not items:
+            break
+
+        batch = _columnar_batch(items, layout, schema)
+        if export_format == 'parquet':
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+        # Each row group leaves the process as soon as it is encoded
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+def streaming_export_response(anomalies: QuerySet, export_format: str) -> StreamingHttpResponse:
+    if export_format in COLUMNAR_FORMATS:
+        if pa is None:
+            raise ImportError(f'pyarrow must be installed to export anomalies as {export_format}')
+        stream = _stream_columnar(anomalies, export_format)
+    elif export_format == 'csv':
+        stream = _stream_csv(anomalies)
+    else:
+        stream = _stream_ndjson(anomalies)
+
+    response = StreamingHttpResponse(stream, content_type=STREAMING_CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="anomalies.{export_format}"'
+    return response
@@ -1,10 +1,10 @@
-import pickle
 from django import forms
 from django.core import validators
 from sklearn.neural_network import MLPClassifier
 from mtehis.model import LearningDetector
 from mtehis.data import LearningDetectorData
 from .models import Toolset
+from . import blob_storage
 
 
 class ToolsetForm(forms.ModelForm):
@@ -50,35 +50,31 @@ class ToolsetForm(forms.ModelForm):
 
         instance = kwargs.get('instance')
 
-        if instance and instance.detector:
-            learning_detector_data: LearningDetectorData = pickle.loads(instance.detector)
-            self.fields['features_count'].initial = learning_detector_data.features_count
+        # Initial values come from the metadata columns, the blobs are never loaded just to render the form
+        if instance and instance.detector_features_count is not None:
+            self.fields['features_count'].initial = instance.detector_features_count
 
-        if instance and instance.classifier and len(instance.classifier) > 0:
-            classifier: MLPClassifier = pickle.loads(instance.classifier)
-            classifier_params = classifier.get_params(True)
-            hidden_layer_sizes_csv = ','.join(map(str, classifier_params['hidden_layer_sizes']))
-            self.fields['classifier_hidden_layer_sizes'].initial = hidden_layer_sizes_csv
+        if instance and instance.classifier_layer_sizes:
+            self.fields['classifier_hidden_layer_sizes'].initial = instance.classifier_layer_sizes
 
     def save(self, commit=True):
         features_count_value = self.cleaned_data.get('features_count')
         classifier_hidden_layer_sizes_value = self.cleaned_data.get('classifier_hidden_layer_sizes')
 
-        if self.instance.detector is not None and len(self.instance.detector) > 0:
-            tmp_learning_detector_data: LearningDetectorData = pickle.loads(self.instance.detector)
-            tmp_learning_detector_data.features_count = features_count_value
-            learning_detector = LearningDetector.create_from_data(tmp_learning_detector_data)
-        else:
-            learning_detector = LearningDetector(features_count_value)
+        if self.instance._state.adding or 'features_count' in self.changed_data:
+            if self.instance.detector is not None and len(self.instance.detector) > 0:
+                tmp_learning_detector_data: LearningDetectorData = blob_storage.loads(self.instance.detector)
+                tmp_learning_detector_data.features_count = features_count_value
+                learning_detector = LearningDetector.create_from_data(tmp_learning_detector_data)
+            else:
+                learning_detector = LearningDetector(features_count_value)
 
-        learning_detector_data = learning_detector.get_data()
-
-        self.instance.detector = pickle.dumps(learning_detector_data)
+            self.instance.set_detector(learning_detector.get_data())
 
         if 'classifier_hidden_layer_sizes' in self.changed_data:
             classifier_hidden_layer_sizes_values = tuple(map(int, classifier_hidden_layer_sizes_value.split(',')))
             classifier = MLPClassifier(hidden_layer_sizes=classifier_hidden_layer_sizes_values)
 
-            self.instance.classifier = pickle.dumps(classifier)
+            self.instance.set_classifier(classifier)
 
         return super().save(commit=commit)
@@ -0,0 +1,65 @@
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from django.conf import settings
+from .toolset_pool import ToolsetPool
+from .workers import setup_worker_process
+
+
+class InferenceBusy(Exception):
+    pass
+
+
+class InferenceExecutor:
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        if kind == 'process':
+            # Every process keeps its own copy of the toolsets it has served
+            self.executor: Executor = ProcessPoolExecutor(max_workers=workers, initializer=setup_worker_process,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+
+        # Counts running and queued predictions, requests beyond the bound are rejected instead of queued
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise InferenceBusy('Too many pending predictions')
+
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_executors: dict[str, InferenceExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_inference_executor(toolset_name: str) -> InferenceExecutor:
+    key = toolset_name if getattr(settings, 'DETECT_EXECUTOR_SCOPE', 'shared') == 'toolset' else ''
+
+    with _executors_lock:
+        if key not in _executors:
+            _executors[key] = InferenceExecutor(
+                getattr(settings, 'DETECT_EXECUTOR', 'thread'),
+                getattr(settings, 'DETECT_EXECUTOR_WORKERS', 4),
+                getattr(settings, 'DETECT_EXECUTOR_MAX_PENDING', 64),
+            )
+        return _executors[key]
+
+
+def predict(toolset_name: str, input_data):
+    started_at = time.perf_counter()
+    toolset = ToolsetPool.get_or_load_toolset(toolset_name)
+    loaded_at = time.perf_counter()
+
+    detection = toolset.detect(input_data)
+
+    timings = {'load': loaded_at - started_at, 'predict': time.perf_counter() - loaded_at}
+    return toolset.id, detection, timings
@@ -0,0 +1,190 @@
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from typing import Optional
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from .models import Toolset, TrainingJob, TrainingJobStatus
+from .toolset_pool import ToolsetPool
+from .datasets import read_dataset
+from .workers import setup_worker_process
+from .timing import StageTimer
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+
+def get_upload_directory() -> str:
+    directory = getattr(settings, 'TRAINING_UPLOAD_DIR', None) or os.path.join(tempfile.gettempdir(), 'mtehis-uploads')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def get_executor() -> Executor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'TRAINING_JOB_WORKERS', 1)
+            if getattr(settings, 'TRAINING_JOB_EXECUTOR', 'thread') == 'process':
+                # Spawned workers set Django up from scratch instead of inheriting open database connections
+                _executor = ProcessPoolExecutor(max_workers=workers, initializer=setup_worker_process,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            else:
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='training-job')
+        return _executor
+
+
+def get_worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _is_worker_alive(worker: str) -> bool:
+    host, _, pid = worker.rpartition(':')
+    # Processes of other hosts cannot be checked from here, their own restart fails their jobs
+    if not worker or host != socket.gethostname():
+        return True
+
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def spool_upload(uploaded_file) -> str:
+    if uploaded_file is None:
+        return ''
+
+    file_descriptor, path = tempfile.mkstemp(dir=get_upload_directory(), suffix='.csv')
+    with os.fdopen(file_descriptor, 'wb') as f:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    return path
+
+
+def enqueue_training_job(toolset: Toolset, train_file=None, test_file=None) -> TrainingJob:
+    job = TrainingJob.objects.create(
+        toolset=toolset,
+        train_file=spool_upload(train_file),
+        test_file=spool_upload(test_file),
+        worker=get_worker_name(),
+    )
+
+    # Workers must not look the job up before it is committed
+    transaction.on_commit(lambda: get_executor().submit(run_training_job, job.id))
+
+    return job
+
+
+def run_training_job(job_id: int):
+    job = None
+    timer = StageTimer()
+    started_at = time.perf_counter()
+    try:
+        job = TrainingJob.objects.select_related('toolset').get(id=job_id)
+        job.status = TrainingJobStatus.processing
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'started_at'])
+
+        progress_interval = getattr(settings, 'TRAINING_JOB_PROGRESS_INTERVAL', 1)
+        last_progress_at = 0
+
+        def _progress_func(i):
+            nonlocal last_progress_at
+            # Progress is written at most once per interval to keep the database out of the training loop
+            now = time.monotonic()
+            if now - last_progress_at >= progress_interval:
+                last_progress_at = now
+                TrainingJob.objects.filter(id=job_id).update(iteration=i)
+
+        with timer.stage('load'):
+            toolset = ToolsetPool.get_or_load_toolset(job.toolset.name)
+        dtype = getattr(settings, 'TRAINING_DTYPE', 'float64')
+        # Pinned while the datasets are read as well, the evaluation alone only pins it once it started
+        with toolset.pinned():
+            with timer.stage('read'):
+                train_data, test_data = read_dataset(job.train_file, dtype), read_dataset(job.test_file, dtype)
+            with timer.stage('evaluate'):
+                toolset.start_evaluation(train_data, test_data, save_results=True, progress_func=_progress_func)
+
+        job.iteration = toolset.evaluation_info.iteration
+        job.result = toolset.evaluation_info.result
+        job.status = TrainingJobStatus.finished
+    except Exception:
+        logger.exception('Training job %s failed', job_id)
+        if job is not None:
+            job.status = TrainingJobStatus.failed
+            job.error = traceback.format_exc()
+    finally:
+        if job is not None:
+            job.finished_at = timezone.now()
+            job.save(update_fields=['status', 'iteration', 'result', 'error', 'finished_at'])
+            _remove_spooled_files(job)
+            metrics.observe_stages('train_job', job.toolset.name, timer)
+            if metrics.is_enabled():
+                metrics.TRAINING_JOB_SECONDS.observe(time.perf_counter() - started_at, toolset=job.toolset.name,
+                                                     status=job.status)
+        connection.close()
+
+
+def _remove_spooled_files(job: TrainingJob):
+    for path in (job.train_file, job.test_file):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def fail_orphaned_job(job: TrainingJob) -> bool:
+    # Jobs live in the executor queue of the process that created them and are lost when it exits
+    if job.status not in (TrainingJobStatus.queued, TrainingJobStatus.processing) or _is_worker_alive(job.worker):
+        return False
+
+    job.error = f'Worker {job.worker} exited before the job finished'
+    job.finished_at = timezone.now()
+    # The status condition keeps a job that finished in the meantime as it is
+    updated = TrainingJob.objects.filter(id=job.id, status=job.status).update(
+        status=TrainingJobStatus.failed, error=job.error, finished_at=job.finished_at)
+    if not updated:
+        job.refresh_from_db()
+        return False
+
+    job.status = TrainingJobStatus.failed
+    _remove_spooled_files(job)
+    logger.warning('Training job %s failed: %s', job.id, job.error)
+    return True
+
+
+def fail_orphaned_jobs() -> int:
+    try:
+        jobs = list(TrainingJob.objects.filter(status__in=[TrainingJobStatus.queued, TrainingJobStatus.processing]))
+    except DatabaseError:
+        # Servers may start before the database is migrated
+        logger.warning('Could not check for orphaned training jobs', exc_info=True)
+        return 0
+    return sum(fail_orphaned_job(job) for job in jobs)
+
+
+def serialize_job(job: TrainingJob) -> dict:
+    return {
+        'job': job.id,
+        'toolset': job.toolset.name,
+        'evaluation': job.status,
+        'iteration': job.iteration,
+        'result': job.result,
+        'error': job.error or None,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
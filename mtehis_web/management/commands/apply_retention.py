@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from mtehis_web.models import Toolset
+from mtehis_web.retention import rollup_toolset, purge_toolset
+
+
+class Command(BaseCommand):
+    help = ('Rolls up anomalies of finished hours into hourly and daily summaries, then deletes rolled up anomalies '
+            'older than the retention horizon of their toolset in small batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Toolset names, defaults to every toolset')
+        parser.add_argument('--batch-size', type=int, default=None, help='Anomalies read or deleted at a time')
+        parser.add_argument('--archive', metavar='DIR', help='Append deleted anomalies to gzipped NDJSON files here')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and repeat every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            toolsets = Toolset.objects.only('id', 'name', 'retention_days', 'rollup_watermark')
+            if options['names']:
+                toolsets = toolsets.filter(name__in=options['names'])
+
+            for toolset in toolsets:
+                rolled_up = rollup_toolset(toolset, batch_size=options['batch_size'])
+                deleted = purge_toolset(toolset, batch_size=options['batch_size'], archive_directory=options['archive'])
+                self.stdout.write(self.style.SUCCESS(f'{toolset.name}: rolled up {rolled_up}, deleted {deleted}'))
+
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from mtehis_web.models import Toolset
+from mtehis_web import blob_storage
+
+
+class Command(BaseCommand):
+    help = 'Removes detector and classifier files from TOOLSET_BLOB_DIR that no toolset references anymore.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=3600,
+                            help='Seconds a file must exist before it is removed, protects saves in progress')
+
+    def handle(self, *args, **options):
+        checksums = set()
+        for detector_checksum, classifier_checksum in Toolset.objects.values_list('detector_checksum',
+                                                                                  'classifier_checksum'):
+            checksums.update([detector_checksum, classifier_checksum])
+
+        removed = blob_storage.remove_unreferenced(checksums, options['min_age'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} unreferenced blob files'))
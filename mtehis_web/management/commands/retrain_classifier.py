@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from mtehis_web.models import Toolset
+from mtehis_web.classifier_training import retrain_classifier
+
+
+class Command(BaseCommand):
+    help = 'Updates toolset classifiers with anomalies labelled since their last retraining.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Toolset names, defaults to every toolset with a classifier')
+        parser.add_argument('--batch-size', type=int, default=None, help='Anomalies learned per partial_fit call')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(
+            Toolset.objects.filter(classifier__isnull=False).values_list('name', flat=True)
+        )
+
+        failed = []
+        for name in names:
+            try:
+                learned = retrain_classifier(name, options['batch_size'])
+            except (Toolset.DoesNotExist, ValueError) as e:
+                self.stderr.write(f'{name}: {e}')
+                failed.append(name)
+                continue
+            self.stdout.write(self.style.SUCCESS(f'{name}: learned {learned} anomalies'))
+
+        if failed:
+            raise CommandError('Failed to retrain: ' + ', '.join(failed))
@@ -0,0 +1,57 @@
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from mtehis_web.models import Toolset
+from mtehis_web.sweep import run_sweep, promote
+
+
+class Command(BaseCommand):
+    help = ('Evaluates a grid of detector features counts and classifier hidden layer sizes against the same datasets '
+            'in parallel and optionally promotes the best detector into the toolset.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('toolset', help='Toolset name')
+        parser.add_argument('--train', required=True, help='Train dataset CSV')
+        parser.add_argument('--test', help='Test dataset CSV')
+        parser.add_argument('--features-count', type=int, nargs='+', required=True)
+        parser.add_argument('--hidden-layer-sizes', nargs='*', default=[], help='Comma separated sizes per variant')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the CPU count')
+        parser.add_argument('--output', help='Write the comparison table to this CSV file')
+        parser.add_argument('--promote', action='store_true', help='Save the best detector into the toolset')
+        parser.add_argument('--metric', help='Detector result column that ranks configurations for --promote')
+        parser.add_argument('--minimize', action='store_true', help='Lower --metric values are better')
+
+    def handle(self, *args, **options):
+        try:
+            toolset = Toolset.objects.get(name=options['toolset'])
+        except Toolset.DoesNotExist:
+            raise CommandError(f'Toolset {options["toolset"]} does not exist')
+
+        if options['promote'] and not options['metric']:
+            raise CommandError('--promote requires --metric')
+
+        hidden_layer_sizes = [tuple(map(int, sizes.split(','))) for sizes in options['hidden_layer_sizes']]
+
+        with tempfile.TemporaryDirectory(prefix='mtehis-sweep-') as directory:
+            table, detectors = run_sweep(options['train'], options['test'], options['features_count'],
+                                         hidden_layer_sizes, directory, options['workers'])
+
+        if options['output']:
+            table.to_csv(options['output'], index=False)
+        self.stdout.write(table.to_string())
+
+        if not options['promote']:
+            return
+
+        metric = options['metric']
+        if metric not in table.columns:
+            raise CommandError(f'Unknown metric {metric}, available: {", ".join(map(str, table.columns))}')
+
+        # Configurations are ranked on the test set results, or on the training set ones without a test set
+        stage = 'test' if options['test'] else 'trained'
+        candidates = table[table['name'] == stage]
+        if candidates[metric].isna().all():
+            raise CommandError(f'No {stage} results to rank by {metric}')
+        best = candidates.loc[candidates[metric].idxmin() if options['minimize'] else candidates[metric].idxmax()]
+
+        promote(toolset, detectors[int(best['features_count'])])
+        self.stdout.write(self.style.SUCCESS(f'Promoted features count {int(best["features_count"])}'))
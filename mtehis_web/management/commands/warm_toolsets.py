@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from mtehis_web.toolset_pool import ToolsetPool
+
+
+class Command(BaseCommand):
+    help = ('Loads toolsets into the pool of this process. With TOOLSET_SHARED_CACHE_DIR set this publishes the '
+            'shared model files, so web workers attach to them instead of deserializing the models.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Toolset names, defaults to the TOOLSET_PRELOAD setting')
+        parser.add_argument('--all', action='store_true', help='Load every toolset')
+
+    def handle(self, *args, **options):
+        names = '__all__' if options['all'] else (options['names'] or None)
+        requested = ToolsetPool.get_preload_names(names)
+
+        loaded = ToolsetPool.preload(requested)
+
+        for name in loaded:
+            self.stdout.write(self.style.SUCCESS(f'Loaded {name}'))
+
+        failed = [name for name in requested if name not in loaded]
+        if failed:
+            raise CommandError('Failed to load: ' + ', '.join(failed))
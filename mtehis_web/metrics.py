@@ -0,0 +1,231 @@
+"""
+In-process metrics exposed in the Prometheus text format.
+
+Every worker process keeps its own values, so a scrape reports the process that served it, like the toolset pool
+statistics. Observations take one lock and a bisect, so the middleware can stay enabled in production.
+"""
+import time
+import bisect
+import threading
+from typing import Optional
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from .timing import StageTimer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ROWS_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        # For totals counted elsewhere and copied by a collector
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: list = None):
+        super().__init__(name, documentation, label_names)
+        self.buckets = list(buckets or LATENCY_BUCKETS)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Counts per bucket (the last one is +Inf), sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        bucket_counts, total, count = value
+        label_names = (*self.label_names, 'le')
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip([*self.buckets, '+Inf'], bucket_counts):
+            cumulative += bucket_count
+            le = bound if isinstance(bound, str) else _format_value(bound)
+            lines.append(f'{self.name}_bucket{_format_labels(label_names, (*key, le))} {cumulative}')
+        labels = _format_labels(self.label_names, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # Collectors copy statistics kept elsewhere into their metrics right before rendering
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'mtehis_http_request_duration_seconds', 'Time until the response is returned, streaming bodies excluded',
+    ('endpoint', 'method', 'status')))
+STAGE_SECONDS = registry.register(Histogram(
+    'mtehis_stage_duration_seconds', 'Time spent in a stage of a request or training job',
+    ('endpoint', 'toolset', 'stage')))
+REQUEST_ROWS = registry.register(Histogram(
+    'mtehis_detect_rows', 'Rows per detect request', ('endpoint', 'toolset'), ROWS_BUCKETS))
+REQUEST_ANOMALIES = registry.register(Histogram(
+    'mtehis_detect_anomalies', 'Anomalies detected per detect request', ('endpoint', 'toolset'), ROWS_BUCKETS))
+TOOLSET_LOAD_SECONDS = registry.register(Histogram(
+    'mtehis_toolset_load_seconds', 'Time to load a toolset into the pool', ('toolset',)))
+TRAINING_JOB_SECONDS = registry.register(Histogram(
+    'mtehis_training_job_duration_seconds', 'Duration of training jobs run by this process', ('toolset', 'status'),
+    [1, 10, 30, 60, 300, 600, 1800, 3600, 7200]))
+POOL_EVENTS = registry.register(Counter(
+    'mtehis_toolset_pool_events_total', 'Toolset pool hits, misses, evictions and reloads', ('event',)))
+POOL_ENTRIES = registry.register(Gauge(
+    'mtehis_toolset_pool_entries', 'Toolsets loaded in the pool'))
+POOL_BYTES = registry.register(Gauge(
+    'mtehis_toolset_pool_bytes', 'Estimated size of the toolsets loaded in the pool'))
+SINK_STATS = registry.register(Gauge(
+    'mtehis_anomaly_sink', 'Write-behind anomaly sink statistics', ('stat',)))
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+def get_stage_timer(request) -> StageTimer:
+    timer = getattr(request, 'stage_timer', None)
+    if timer is None:
+        timer = request.stage_timer = StageTimer()
+    return timer
+
+
+def get_endpoint(request) -> str:
+    # URL names instead of paths keep the number of label values bounded
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.route
+
+
+def observe_stages(endpoint: str, toolset: Optional[str], timer: StageTimer):
+    if not is_enabled():
+        return
+    for stage, seconds in timer.stages.items():
+        STAGE_SECONDS.observe(seconds, endpoint=endpoint, toolset=toolset or '', stage=stage)
+
+
+def observe_detection(request, toolset: str, rows: int, anomalies: int):
+    request.metrics_toolset = toolset
+    if not is_enabled():
+        return
+    endpoint = get_endpoint(request)
+    REQUEST_ROWS.observe(rows, endpoint=endpoint, toolset=toolset)
+    REQUEST_ANOMALIES.observe(anomalies, endpoint=endpoint, toolset=toolset)
+
+
+def _observe_request(request, response, started_at: float):
+    endpoint = get_endpoint(request)
+    REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=endpoint, method=request.method,
+                            status=response.status_code)
+    timer = getattr(request, 'stage_timer', None)
+    if timer is not None:
+        observe_stages(endpoint, getattr(request, 'metrics_toolset', None), timer)
+
+
+def metrics_middleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started_at = time.perf_counter()
+            response = await get_response(request)
+            if is_enabled():
+                _observe_request(request, response, started_at)
+            return response
+
+        return markcoroutinefunction(middleware)
+
+    def middleware(request):
+        started_at = time.perf_counter()
+        response = get_response(request)
+        if is_enabled():
+            _observe_request(request, response, started_at)
+        return response
+
+    return middleware
+
+
+metrics_middleware.sync_capable = True
+metrics_middleware.async_capable = True
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,78 @@
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    idle_timeout = 30
+
+    def __init__(self, predict_func, window: float, max_rows: int):
+        self.predict_func = predict_func
+        self.window = window
+        self.max_rows = max_rows
+        self.stats = {'requests': 0, 'batches': 0}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def predict_with_scores(self, input_data: np.ndarray):
+        future = Future()
+        with self._lock:
+            self._queue.put((input_data, future))
+            # The worker thread exits when idle, so batchers of evicted toolsets do not keep threads alive
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+        return future.result()
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+
+            batch = [first]
+            rows = len(first[0])
+            deadline = time.monotonic() + self.window
+            while rows < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+
+            self._process(batch)
+
+    def _process(self, batch: list[tuple[np.ndarray, Future]]):
+        # Requests can only be stacked with others of the same row shape
+        groups: dict[tuple, list[tuple[np.ndarray, Future]]] = {}
+        for input_data, future in batch:
+            groups.setdefault((input_data.shape[1:], input_data.dtype.str), []).append((input_data, future))
+
+        for group in groups.values():
+            try:
+                input_data = np.concatenate([item[0] for item in group]) if len(group) > 1 else group[0][0]
+                predicted, scores = self.predict_func(input_data)
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+
+            self.stats['requests'] += len(group)
+            self.stats['batches'] += 1
+
+            offsets = np.cumsum([len(item[0]) for item in group])[:-1]
+            for (_, future), item_predicted, item_scores in zip(group, np.split(predicted, offsets),
+                                                                np.split(scores, offsets)):
+                future.set_result((item_predicted, item_scores))
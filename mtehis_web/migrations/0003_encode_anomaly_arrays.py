@@ -0,0 +1,68 @@
+import pickle
+from django.db import migrations, transaction
+from mtehis_web.array_codec import is_encoded, encode_array, decode_array
+
+CHUNK_SIZE = 1000
+ARRAY_FIELDS = ['inputs', 'detector_scores', 'classifier_scores']
+
+
+def _rewrite_anomalies(apps, schema_editor, convert):
+    Anomaly = apps.get_model('mtehis_web', 'Anomaly')
+    db_alias = schema_editor.connection.alias
+    last_id = 0
+
+    while True:
+        with transaction.atomic(using=db_alias):
+            chunk = list(
+                Anomaly.objects.using(db_alias)
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', *ARRAY_FIELDS)[:CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+
+            changed = [anomaly for anomaly in chunk if convert(anomaly)]
+            if changed:
+                Anomaly.objects.using(db_alias).bulk_update(changed, ARRAY_FIELDS)
+
+        last_id = chunk[-1].id
+
+
+def encode_legacy_arrays(apps, schema_editor):
+    def convert(anomaly):
+        changed = False
+        for field in ARRAY_FIELDS:
+            value = getattr(anomaly, field)
+            if value is not None and len(value) > 0 and not is_encoded(value):
+                setattr(anomaly, field, encode_array(pickle.loads(value)))
+                changed = True
+        return changed
+
+    _rewrite_anomalies(apps, schema_editor, convert)
+
+
+def decode_to_legacy_arrays(apps, schema_editor):
+    def convert(anomaly):
+        changed = False
+        for field in ARRAY_FIELDS:
+            value = getattr(anomaly, field)
+            if is_encoded(value):
+                setattr(anomaly, field, pickle.dumps(decode_array(value).tolist()))
+                changed = True
+        return changed
+
+    _rewrite_anomalies(apps, schema_editor, convert)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("mtehis_web", "0002_alter_anomalyclassmapping_unique_together"),
+    ]
+
+    operations = [
+        migrations.RunPython(encode_legacy_arrays, decode_to_legacy_arrays),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0003_encode_anomaly_arrays"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="anomaly",
+            options={"ordering": ["-created_at"], "verbose_name_plural": "Anomalies"},
+        ),
+        migrations.AlterModelOptions(
+            name="anomalyclass",
+            options={"ordering": ["name"], "verbose_name_plural": "Anomaly classes"},
+        ),
+        migrations.AddIndex(
+            model_name="anomaly",
+            index=models.Index(
+                fields=["toolset", "created_at"], name="anomaly_toolset_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="anomaly",
+            index=models.Index(
+                fields=["toolset", "label"], name="anomaly_toolset_label_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0004_anomaly_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="toolset",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="revision",
+            field=models.PositiveIntegerField(
+                default=0,
+                editable=False,
+                help_text="Incremented on every save, used to detect stale loaded toolsets",
+            ),
+        ),
+    ]
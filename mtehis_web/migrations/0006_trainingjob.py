@@ -0,0 +1,78 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0005_toolset_revision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TrainingJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "Queued"),
+                            ("processing", "Processing"),
+                            ("finished", "Finished"),
+                            ("failed", "Failed"),
+                        ],
+                        default="queued",
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "iteration",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Last iteration reported by the detector"
+                    ),
+                ),
+                (
+                    "train_file",
+                    models.CharField(
+                        blank=True,
+                        help_text="Path of the spooled train dataset",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "test_file",
+                    models.CharField(
+                        blank=True,
+                        help_text="Path of the spooled test dataset",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "result",
+                    models.TextField(help_text="Evaluation result as JSON", null=True),
+                ),
+                ("error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(null=True)),
+                ("finished_at", models.DateTimeField(null=True)),
+                (
+                    "toolset",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="mtehis_web.toolset"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-created_at"],
+            },
+        ),
+    ]
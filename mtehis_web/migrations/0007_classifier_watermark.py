@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0006_trainingjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="toolset",
+            name="classifier_watermark",
+            field=models.DateTimeField(
+                editable=False,
+                help_text="Labelling time of the last anomaly the classifier learned",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="classifier_watermark_id",
+            field=models.PositiveBigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Id of the last anomaly the classifier learned",
+            ),
+        ),
+        migrations.AddField(
+            model_name="anomaly",
+            name="labelled_at",
+            field=models.DateTimeField(
+                blank=True, help_text="Set when the label is assigned by hand", null=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="anomaly",
+            index=models.Index(
+                fields=["toolset", "labelled_at"], name="anomaly_toolset_labelled_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,71 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0007_classifier_watermark"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="toolset",
+            name="detector_features_count",
+            field=models.PositiveIntegerField(
+                editable=False,
+                help_text="Features count of the serialized detector",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="classifier_layer_sizes",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                help_text="Comma separated hidden layer sizes of the serialized classifier",
+                max_length=128,
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="detector_size",
+            field=models.PositiveBigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Size of the serialized detector in bytes",
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="classifier_size",
+            field=models.PositiveBigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Size of the serialized classifier in bytes",
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="detector_checksum",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                help_text="SHA-256 of the serialized detector",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="classifier_checksum",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                help_text="SHA-256 of the serialized classifier",
+                max_length=64,
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+import pickle
+import hashlib
+from django.db import migrations
+
+
+def backfill_metadata(apps, schema_editor):
+    Toolset = apps.get_model('mtehis_web', 'Toolset')
+    db_alias = schema_editor.connection.alias
+
+    # Toolsets are few, but each one is loaded separately to hold a single pair of blobs in memory
+    for toolset_id in Toolset.objects.using(db_alias).values_list('id', flat=True):
+        toolset = Toolset.objects.using(db_alias).get(id=toolset_id)
+
+        if toolset.detector:
+            toolset.detector_features_count = pickle.loads(toolset.detector).features_count
+            toolset.detector_size = len(toolset.detector)
+            toolset.detector_checksum = hashlib.sha256(toolset.detector).hexdigest()
+
+        if toolset.classifier:
+            sizes = pickle.loads(toolset.classifier).hidden_layer_sizes
+            toolset.classifier_layer_sizes = ','.join(map(str, [sizes] if isinstance(sizes, int) else sizes))
+            toolset.classifier_size = len(toolset.classifier)
+            toolset.classifier_checksum = hashlib.sha256(toolset.classifier).hexdigest()
+
+        toolset.save(update_fields=['detector_features_count', 'detector_size', 'detector_checksum',
+                                    'classifier_layer_sizes', 'classifier_size', 'classifier_checksum'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0008_toolset_metadata"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0009_backfill_toolset_metadata"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="anomaly",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,94 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0010_anomaly_created_at_default"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="toolset",
+            name="retention_days",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Days raw anomalies are kept, empty uses the default",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="toolset",
+            name="rollup_watermark",
+            field=models.DateTimeField(
+                editable=False,
+                help_text="Anomalies created before this time are rolled up",
+                null=True,
+            ),
+        ),
+        migrations.CreateModel(
+            name="AnomalyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("hour", "Hour"), ("day", "Day")], max_length=4
+                    ),
+                ),
+                ("period_start", models.DateTimeField()),
+                ("count", models.PositiveIntegerField()),
+                (
+                    "score_sum",
+                    models.BinaryField(help_text="Per feature sum of detector scores"),
+                ),
+                (
+                    "score_sum_squares",
+                    models.BinaryField(
+                        help_text="Per feature sum of squared detector scores"
+                    ),
+                ),
+                (
+                    "score_min",
+                    models.BinaryField(help_text="Per feature minimum of detector scores"),
+                ),
+                (
+                    "score_max",
+                    models.BinaryField(help_text="Per feature maximum of detector scores"),
+                ),
+                (
+                    "label",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="mtehis_web.anomalyclass",
+                    ),
+                ),
+                (
+                    "toolset",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="mtehis_web.toolset",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["toolset", "period", "period_start"],
+                "indexes": [
+                    models.Index(
+                        fields=["toolset", "period", "period_start"],
+                        name="rollup_toolset_period_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mtehis_web", "0011_anomaly_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trainingjob",
+            name="worker",
+            field=models.CharField(
+                blank=True,
+                help_text="Host and process id of the queueing process",
+                max_length=255,
+            ),
+        ),
+    ]
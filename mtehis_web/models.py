@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import F
 from django.urls import reverse
+from django.utils import timezone
+from . import blob_storage
 
 
 class Toolset(models.Model):
@@ -13,11 +16,110 @@ class Toolset(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    updated_at = models.DateTimeField(auto_now=True)
+
+    revision = models.PositiveIntegerField(default=0, editable=False,
+                                           help_text='Incremented on every save, used to detect stale loaded toolsets')
+
+    classifier_watermark = models.DateTimeField(null=True, editable=False,
+                                                help_text='Labelling time of the last anomaly the classifier learned')
+
+    classifier_watermark_id = models.PositiveBigIntegerField(default=0, editable=False,
+                                                             help_text='Id of the last anomaly the classifier learned')
+
+    detector_features_count = models.PositiveIntegerField(null=True, editable=False,
+                                                          help_text='Features count of the serialized detector')
+
+    classifier_layer_sizes = models.CharField(max_length=128, blank=True, default='', editable=False,
+                                              help_text='Comma separated hidden layer sizes of the serialized '
+                                                        'classifier')
+
+    detector_size = models.PositiveBigIntegerField(default=0, editable=False,
+                                                   help_text='Size of the serialized detector in bytes')
+
+    classifier_size = models.PositiveBigIntegerField(default=0, editable=False,
+                                                     help_text='Size of the serialized classifier in bytes')
+
+    detector_checksum = models.CharField(max_length=64, blank=True, default='', editable=False,
+                                         help_text='SHA-256 of the serialized detector')
+
+    classifier_checksum = models.CharField(max_length=64, blank=True, default='', editable=False,
+                                           help_text='SHA-256 of the serialized classifier')
+
+    retention_days = models.PositiveIntegerField(null=True, blank=True,
+                                                 help_text='Days raw anomalies are kept, empty uses the default')
+
+    rollup_watermark = models.DateTimeField(null=True, editable=False,
+                                            help_text='Anomalies created before this time are rolled up')
+
+    METADATA_FIELDS = {
+        'detector': ['detector_features_count', 'detector_size', 'detector_checksum'],
+        'classifier': ['classifier_layer_sizes', 'classifier_size', 'classifier_checksum'],
+    }
+
     # Metadata
     class Meta:
         ordering = ['name', '-created_at']
 
     # Methods
+    def set_detector(self, detector_data):
+        self._set_model('detector', detector_data)
+
+    def set_classifier(self, classifier):
+        self._set_model('classifier', classifier)
+
+    def _set_model(self, field: str, model):
+        data = blob_storage.serialize(model) if model is not None else b''
+        checksum = blob_storage.get_checksum(data)
+        # Unchanged content is not rewritten, a deferred blob is then left out of the update
+        if not self._state.adding and checksum == getattr(self, f'{field}_checksum'):
+            return
+        self._store_blob(field, data, model, checksum)
+
+    def _store_blob(self, field: str, data: bytes, model, checksum: str):
+        empty = None if self._meta.get_field(field).null else b''
+        setattr(self, field, blob_storage.store(data, checksum) if data else empty)
+        setattr(self, f'{field}_size', len(data))
+        setattr(self, f'{field}_checksum', checksum)
+        if field == 'detector':
+            self.detector_features_count = model.features_count if model is not None else None
+        else:
+            sizes = getattr(model, 'hidden_layer_sizes', ())
+            self.classifier_layer_sizes = ','.join(map(str, [sizes] if isinstance(sizes, int) else sizes))
+
+    def _sync_blob(self, field: str) -> bool:
+        value = getattr(self, field)
+        checksum = blob_storage.get_checksum(value)
+        if checksum == getattr(self, f'{field}_checksum') and not blob_storage.needs_store(value):
+            return False
+
+        # Blobs assigned directly are only loaded when their content changed or they still have to be stored
+        data = blob_storage.load(value)
+        self._store_blob(field, data, blob_storage.loads(data), checksum)
+        return True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        deferred_fields = self.get_deferred_fields()
+        metadata_fields = []
+        for field, fields in self.METADATA_FIELDS.items():
+            if field in deferred_fields or (update_fields is not None and field not in update_fields):
+                continue
+            if self._sync_blob(field):
+                metadata_fields += fields
+
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, *metadata_fields, 'revision', 'updated_at'}
+
+        if self._state.adding:
+            self.revision = 1
+            super().save(*args, **kwargs)
+        else:
+            # Incremented in the database so concurrent saves never end up with the same revision
+            self.revision = F('revision') + 1
+            super().save(*args, **kwargs)
+            self.refresh_from_db(fields=['revision'])
+
     def get_absolute_url(self):
         return reverse('toolset', args=[str(self.id)])
 
@@ -78,12 +180,19 @@ class Anomaly(models.Model):
 
     label = models.ForeignKey(AnomalyClass, on_delete=models.SET_NULL, null=True)
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    labelled_at = models.DateTimeField(null=True, blank=True, help_text='Set when the label is assigned by hand')
+
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     # Metadata
     class Meta:
         ordering = ['-created_at']
         verbose_name_plural = 'Anomalies'
+        indexes = [
+            models.Index(fields=['toolset', 'created_at'], name='anomaly_toolset_created_idx'),
+            models.Index(fields=['toolset', 'label'], name='anomaly_toolset_label_idx'),
+            models.Index(fields=['toolset', 'labelled_at'], name='anomaly_toolset_labelled_idx'),
+        ]
 
     # Methods
     def get_absolute_url(self):
@@ -91,3 +200,85 @@ class Anomaly(models.Model):
 
     def __str__(self):
         return 'Anomaly: ' + str(self.label.name if self.label is not None else 'unknown')
+
+
+class TrainingJobStatus(models.TextChoices):
+    queued = 'queued'
+    processing = 'processing'
+    finished = 'finished'
+    failed = 'failed'
+
+
+class TrainingJob(models.Model):
+
+    # Fields
+    toolset = models.ForeignKey(Toolset, on_delete=models.CASCADE)
+
+    status = models.CharField(max_length=16, choices=TrainingJobStatus.choices, default=TrainingJobStatus.queued)
+
+    iteration = models.PositiveIntegerField(default=0, help_text='Last iteration reported by the detector')
+
+    train_file = models.CharField(max_length=255, blank=True, help_text='Path of the spooled train dataset')
+
+    test_file = models.CharField(max_length=255, blank=True, help_text='Path of the spooled test dataset')
+
+    worker = models.CharField(max_length=255, blank=True, help_text='Host and process id of the queueing process')
+
+    result = models.TextField(null=True, help_text='Evaluation result as JSON')
+
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    started_at = models.DateTimeField(null=True)
+
+    finished_at = models.DateTimeField(null=True)
+
+    # Metadata
+    class Meta:
+        ordering = ['-created_at']
+
+    # Methods
+    def get_absolute_url(self):
+        return reverse('training-job', args=[str(self.id)])
+
+    def __str__(self):
+        return 'Training job #' + str(self.id) + ' (' + self.status + ')'
+
+
+class RollupPeriod(models.TextChoices):
+    hour = 'hour'
+    day = 'day'
+
+
+class AnomalyRollup(models.Model):
+
+    # Fields
+    toolset = models.ForeignKey(Toolset, on_delete=models.CASCADE)
+
+    period = models.CharField(max_length=4, choices=RollupPeriod.choices)
+
+    period_start = models.DateTimeField()
+
+    label = models.ForeignKey(AnomalyClass, on_delete=models.SET_NULL, null=True)
+
+    count = models.PositiveIntegerField()
+
+    score_sum = models.BinaryField(help_text='Per feature sum of detector scores')
+
+    score_sum_squares = models.BinaryField(help_text='Per feature sum of squared detector scores')
+
+    score_min = models.BinaryField(help_text='Per feature minimum of detector scores')
+
+    score_max = models.BinaryField(help_text='Per feature maximum of detector scores')
+
+    # Metadata
+    class Meta:
+        ordering = ['toolset', 'period', 'period_start']
+        indexes = [
+            models.Index(fields=['toolset', 'period', 'period_start'], name='rollup_toolset_period_idx'),
+        ]
+
+    # Methods
+    def __str__(self):
+        return self.toolset.name + ' ' + self.period + ' ' + self.period_start.isoformat()
@@ -0,0 +1,227 @@
+import os
+import gzip
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Optional
+import numpy as np
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Toolset, Anomaly, AnomalyRollup, RollupPeriod
+from .array_codec import encode_array, decode_array, decode_row_groups
+from .exports import EXPORT_FIELDS, decode_anomaly
+
+PERIOD_SECONDS = {RollupPeriod.hour: 3600, RollupPeriod.day: 86400}
+
+
+def get_retention_batch_size() -> int:
+    return getattr(settings, 'ANOMALY_RETENTION_BATCH_SIZE', 5000)
+
+
+def get_rollup_delay() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'ANOMALY_ROLLUP_DELAY', 300))
+
+
+def get_retention_days(toolset: Toolset) -> Optional[int]:
+    if toolset.retention_days is not None:
+        return toolset.retention_days
+    return getattr(settings, 'ANOMALY_RETENTION_DAYS', None)
+
+
+def _floor(value: datetime, period: str) -> datetime:
+    seconds = PERIOD_SECONDS[period]
+    return datetime.fromtimestamp(int(value.timestamp()) // seconds * seconds, tz=dt_timezone.utc)
+
+
+class ScoreStats:
+
+    def __init__(self, count: int, score_sum: np.ndarray, sum_squares: np.ndarray, score_min: np.ndarray,
+                 score_max: np.ndarray):
+        self.count = count
+        self.score_sum = score_sum
+        self.sum_squares = sum_squares
+        self.score_min = score_min
+        self.score_max = score_max
+
+    @classmethod
+    def from_rollup(cls, rollup: AnomalyRollup) -> 'ScoreStats':
+        return cls(rollup.count, decode_array(rollup.score_sum), decode_array(rollup.score_sum_squares),
+                   decode_array(rollup.score_min), decode_array(rollup.score_max))
+
+    def merge(self, other: 'ScoreStats') -> 'ScoreStats':
+        # Scores of a changed features count cannot be combined. The larger group is kept whole, so the count
+        # always matches the rows the score statistics describe.
+        if self.score_sum.shape != other.score_sum.shape:
+            return other if other.count > self.count else self
+        return ScoreStats(self.count + other.count, self.score_sum + other.score_sum,
+                          self.sum_squares + other.sum_squares, np.minimum(self.score_min, other.score_min),
+                          np.maximum(self.score_max, other.score_max))
+
+    def to_rollup(self, toolset_id: int, period: str, period_start: datetime, label_id: Optional[int]):
+        return AnomalyRollup(toolset_id=toolset_id, period=period, period_start=period_start, label_id=label_id,
+                             count=self.count, score_sum=encode_array(self.score_sum, np.float64),
+                             score_sum_squares=encode_array(self.sum_squares, np.float64),
+                             score_min=encode_array(self.score_min, np.float64),
+                             score_max=encode_array(self.score_max, np.float64))
+
+    def to_dict(self) -> dict:
+        mean = self.score_sum / self.count
+        return {
+            'count': self.count,
+            'detector_score_mean': mean.tolist(),
+            'detector_score_std': np.sqrt(np.maximum(self.sum_squares / self.count - mean ** 2, 0)).tolist(),
+            'detector_score_min': self.score_min.tolist(),
+            'detector_score_max': self.score_max.tolist(),
+        }
+
+
+def _accumulate(stats: dict, hours: np.ndarray, labels: np.ndarray, scores: np.ndarray):
+    order = np.lexsort((labels, hours))
+    hours, labels, scores = hours[order], labels[order], scores[order].astype(np.float64)
+
+    # One reduceat per statistic aggregates every (hour, label) group of the chunk
+    starts = np.flatnonzero(np.r_[True, (hours[1:] != hours[:-1]) | (labels[1:] != labels[:-1])])
+    counts = np.diff(np.r_[starts, len(hours)])
+    sums = np.add.reduceat(scores, starts)
+    sum_squares = np.add.reduceat(scores ** 2, starts)
+    minimums = np.minimum.reduceat(scores, starts)
+    maximums = np.maximum.reduceat(scores, starts)
+
+    for i, start in enumerate(starts):
+        key = (int(hours[start]), int(labels[start]))
+        group = ScoreStats(int(counts[i]), sums[i], sum_squares[i], minimums[i], maximums[i])
+        stats[key] = stats[key].merge(group) if key in stats else group
+
+
+def rollup_toolset(toolset: Toolset, now: datetime = None, batch_size: int = None) -> int:
+    batch_size = batch_size or get_retention_batch_size()
+    # The current hour, and rows still buffered by write-behind sinks, are left to a later run
+    cutoff = _floor((now or timezone.now()) - get_rollup_delay(), RollupPeriod.hour)
+    start = toolset.rollup_watermark
+    if start is not None and start >= cutoff:
+        return 0
+
+    anomalies = Anomaly.objects.filter(toolset_id=toolset.id, created_at__lt=cutoff).order_by('created_at', 'id')
+    if start is not None:
+        anomalies = anomalies.filter(created_at__gte=start)
+
+    stats = {}
+    rolled_up = 0
+    last = None
+    while True:
+        batch = anomalies
+        if last is not None:
+            batch = batch.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], id__gt=last[1]))
+        rows = list(batch.values_list('id', 'created_at', 'label_id', 'detector_scores')[:batch_size])
+        if not rows:
+            break
+        last = rows[-1][1], rows[-1][0]
+        rolled_up += len(rows)
+
+        hours = np.array([int(row[1].timestamp()) // PERIOD_SECONDS[RollupPeriod.hour] for row in rows])
+        hours *= PERIOD_SECONDS[RollupPeriod.hour]
+        labels = np.array([row[2] if row[2] is not None else -1 for row in rows])
+        for selected, scores in decode_row_groups([row[3] for row in rows]):
+            _accumulate(stats, hours[selected], labels[selected], scores)
+
+    hourly = [
+        group.to_rollup(toolset.id, RollupPeriod.hour, datetime.fromtimestamp(hour, tz=dt_timezone.utc),
+                        label if label >= 0 else None)
+        for (hour, label), group in stats.items()
+    ]
+    days = {_floor(rollup.period_start, RollupPeriod.day) for rollup in hourly}
+
+    with transaction.atomic():
+        hourly_rollups = AnomalyRollup.objects.filter(toolset_id=toolset.id, period=RollupPeriod.hour,
+                                                      period_start__lt=cutoff)
+        if start is not None:
+            hourly_rollups = hourly_rollups.filter(period_start__gte=start)
+        hourly_rollups.delete()
+        AnomalyRollup.objects.bulk_create(hourly)
+
+        for day in days:
+            _rollup_day(toolset.id, day)
+
+        Toolset.objects.filter(id=toolset.id).update(rollup_watermark=cutoff)
+        toolset.rollup_watermark = cutoff
+
+    return rolled_up
+
+
+def _rollup_day(toolset_id: int, day: datetime):
+    day_end = day + timedelta(seconds=PERIOD_SECONDS[RollupPeriod.day])
+    stats = {}
+    for rollup in AnomalyRollup.objects.filter(toolset_id=toolset_id, period=RollupPeriod.hour,
+                                               period_start__gte=day, period_start__lt=day_end):
+        group = ScoreStats.from_rollup(rollup)
+        stats[rollup.label_id] = stats[rollup.label_id].merge(group) if rollup.label_id in stats else group
+
+    AnomalyRollup.objects.filter(toolset_id=toolset_id, period=RollupPeriod.day, period_start=day).delete()
+    AnomalyRollup.objects.bulk_create([group.to_rollup(toolset_id, RollupPeriod.day, day, label_id)
+                                       for label_id, group in stats.items()])
+
+
+def purge_toolset(toolset: Toolset, now: datetime = None, batch_size: int = None,
+                  archive_directory: str = None) -> int:
+    retention_days = get_retention_days(toolset)
+    # Only rolled up anomalies are removed, so the summaries keep covering them
+    if retention_days is None or toolset.rollup_watermark is None:
+        return 0
+
+    now = now or timezone.now()
+    horizon = min(now - timedelta(days=retention_days), toolset.rollup_watermark)
+    anomalies = Anomaly.objects.filter(toolset_id=toolset.id, created_at__lt=horizon).order_by('created_at', 'id')
+    batch_size = batch_size or get_retention_batch_size()
+
+    archive = None
+    if archive_directory is not None:
+        os.makedirs(archive_directory, exist_ok=True)
+        archive_path = os.path.join(archive_directory, f'{toolset.name}-{now:%Y%m%d%H%M%S}.ndjson.gz')
+        archive = gzip.open(archive_path, 'at')
+
+    deleted = 0
+    try:
+        # Small batches keep every write transaction, and the lock it holds, short
+        while True:
+            if archive is not None:
+                items = list(anomalies.values(*EXPORT_FIELDS)[:batch_size])
+                ids = [item['id'] for item in items]
+                for item in items:
+                    archive.write(json.dumps(decode_anomaly(item), cls=DjangoJSONEncoder) + '\n')
+                archive.flush()
+            else:
+                ids = list(anomalies.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                Anomaly.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    return deleted
+
+
+def summarize(toolset_name: str, period: str, datetime_from: str = None, datetime_to: str = None) -> list[dict]:
+    if period not in PERIOD_SECONDS:
+        raise ValueError(f'Unknown rollup period: {period}')
+
+    query_filter = {'toolset__name': toolset_name, 'period': period}
+    if datetime_from is not None:
+        query_filter['period_start__gte'] = datetime_from
+    if datetime_to is not None:
+        query_filter['period_start__lte'] = datetime_to
+
+    rollups = AnomalyRollup.objects.filter(**query_filter).select_related('label').order_by('period_start', 'label')
+    return [
+        {
+            'period_start': rollup.period_start,
+            'label': rollup.label.name if rollup.label is not None else None,
+            **ScoreStats.from_rollup(rollup).to_dict(),
+        }
+        for rollup in rollups
+    ]
@@ -0,0 +1,103 @@
+"""
+File store of deserialized models shared between worker processes.
+
+Models are pickled with protocol 5 so that numpy buffers are written out-of-band, page aligned, after the pickle
+stream. Workers map the file copy-on-write and unpickle with the mapped buffers, so the numeric arrays of all workers
+are backed by the same page cache pages until one of them writes to an array.
+
+Only the classifier weights are arrays. Detector data is a few scalars and every worker still builds its own streamad
+detectors from it, so for detectors the file only saves fetching, decompressing and unpickling the stored blob.
+"""
+import os
+import mmap
+import pickle
+import struct
+import tempfile
+from pathlib import Path
+from typing import Optional
+from django.conf import settings
+
+MAGIC = b'MTSC'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBxxxQQ')
+_BUFFER_ENTRY = struct.Struct('<QQ')
+_ALIGNMENT = mmap.PAGESIZE
+
+
+def get_cache_directory() -> Optional[Path]:
+    directory = getattr(settings, 'TOOLSET_SHARED_CACHE_DIR', None)
+    return Path(directory) if directory else None
+
+
+def get_path(toolset_id: int, revision: int, kind: str) -> Optional[Path]:
+    directory = get_cache_directory()
+    if directory is None:
+        return None
+    return directory / f'{toolset_id}-{revision}-{kind}.bin'
+
+
+def _align(offset: int) -> int:
+    return offset + (-offset % _ALIGNMENT)
+
+
+def publish(path: Path, obj):
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    buffers = [buffer.raw() for buffer in buffers]
+
+    table_offset = _HEADER.size
+    payload_offset = table_offset + _BUFFER_ENTRY.size * len(buffers)
+    offset = _align(payload_offset + len(payload))
+    entries = []
+    for buffer in buffers:
+        entries.append((offset, buffer.nbytes))
+        offset = _align(offset + buffer.nbytes)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, len(payload), len(buffers)))
+            for entry in entries:
+                f.write(_BUFFER_ENTRY.pack(*entry))
+            f.write(payload)
+            for (buffer_offset, _), buffer in zip(entries, buffers):
+                f.seek(buffer_offset)
+                f.write(buffer)
+            f.truncate(offset)
+
+        # Readers only ever see complete files
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    _remove_previous_revisions(path)
+
+
+def attach(path: Path):
+    with open(path, 'rb') as f:
+        memory_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    magic, version, payload_size, buffers_count = _HEADER.unpack_from(memory_map)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a shared model cache file')
+
+    view = memoryview(memory_map)
+    buffers = []
+    for i in range(buffers_count):
+        offset, size = _BUFFER_ENTRY.unpack_from(memory_map, _HEADER.size + i * _BUFFER_ENTRY.size)
+        buffers.append(view[offset:offset + size])
+
+    payload_offset = _HEADER.size + _BUFFER_ENTRY.size * buffers_count
+    return pickle.loads(view[payload_offset:payload_offset + payload_size], buffers=buffers)
+
+
+def _remove_previous_revisions(path: Path):
+    toolset_id, revision, kind = path.stem.split('-', 2)
+    for previous in path.parent.glob(f'{toolset_id}-*-{kind}.bin'):
+        previous_revision = previous.stem.split('-', 2)[1]
+        # Workers that still map an older file keep their pages after it is unlinked
+        if previous_revision.isdigit() and int(previous_revision) < int(revision):
+            previous.unlink(missing_ok=True)
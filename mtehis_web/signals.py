@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Toolset, AnomalyClassMapping
+from .toolset_pool import ToolsetPool
+
+
+@receiver(post_save, sender=Toolset)
+def invalidate_saved_toolset(sender, instance: Toolset, **kwargs):
+    transaction.on_commit(lambda: ToolsetPool.invalidate(instance.name))
+
+
+@receiver(post_delete, sender=Toolset)
+def remove_deleted_toolset(sender, instance: Toolset, **kwargs):
+    transaction.on_commit(lambda: ToolsetPool.remove(instance.name))
+
+
+@receiver([post_save, post_delete], sender=AnomalyClassMapping)
+def invalidate_class_mapping(sender, instance: AnomalyClassMapping, **kwargs):
+    transaction.on_commit(lambda: ToolsetPool.invalidate_class_mapping(instance.toolset_id))
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,121 @@
+import os
+import pickle
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.neural_network import MLPClassifier
+from streamad.util import CustomDS
+from mtehis.model import LearningDetector
+from mtehis.util import evaluate
+from .models import Toolset
+from .datasets import prepare_df, get_features
+from .workers import setup_worker_process
+
+
+def share_dataset(path: str, directory: str, name: str) -> Optional[dict]:
+    if not path:
+        return None
+
+    df = prepare_df(pd.read_csv(path))
+    numeric_columns = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column])]
+    other_columns = [column for column in df.columns if column not in numeric_columns]
+
+    numeric_path = os.path.join(directory, f'{name}.npy')
+    np.save(numeric_path, np.ascontiguousarray(df[numeric_columns].to_numpy(np.float64)))
+
+    other_path = None
+    if other_columns:
+        other_path = os.path.join(directory, f'{name}.pkl')
+        df[other_columns].to_pickle(other_path)
+
+    return {
+        'numeric_columns': numeric_columns,
+        'numeric_path': numeric_path,
+        'other_path': other_path,
+    }
+
+
+def load_shared_dataset(dataset: Optional[dict]) -> Optional[pd.DataFrame]:
+    if dataset is None:
+        return None
+
+    # Workers map the parsed columns instead of parsing the CSV again. CustomDS and get_features still copy the
+    # feature columns into arrays of their own, so every worker holds a private copy of them while it evaluates.
+    values = np.load(dataset['numeric_path'], mmap_mode='c')
+    df = pd.DataFrame(values, columns=dataset['numeric_columns'], copy=False)
+    if dataset['other_path']:
+        others = pd.read_pickle(dataset['other_path'])
+        for column in others.columns:
+            df[column] = others[column]
+    return df
+
+
+def evaluate_detector(train_dataset: Optional[dict], test_dataset: Optional[dict], features_count: int):
+    train_df = load_shared_dataset(train_dataset)
+    test_df = load_shared_dataset(test_dataset)
+
+    detector = LearningDetector(features_count)
+    # noinspection PyTypeChecker
+    result = evaluate(detector,
+                      CustomDS(train_df) if train_df is not None else None,
+                      CustomDS(test_df) if test_df is not None else None)
+
+    return result, pickle.dumps(detector.get_data())
+
+
+def evaluate_classifier(train_dataset: Optional[dict], test_dataset: Optional[dict],
+                        hidden_layer_sizes: tuple):
+    train_df = load_shared_dataset(train_dataset)
+    test_df = load_shared_dataset(test_dataset)
+
+    # Classifiers can only be scored against datasets that carry labels
+    if train_df is None or test_df is None or 'label' not in train_df.columns or 'label' not in test_df.columns:
+        return np.nan
+
+    # The datasets only label rows as anomalous or not, while the toolset classifier predicts the anomaly classes
+    # of AnomalyClassMapping. The score compares hidden layer sizes, the classifier itself is never promoted.
+    classifier = MLPClassifier(hidden_layer_sizes=hidden_layer_sizes)
+    classifier.fit(get_features(train_df), train_df['label'].to_numpy())
+    return classifier.score(get_features(test_df), test_df['label'].to_numpy())
+
+
+def run_sweep(train_path: str, test_path: str, features_counts: list[int], hidden_layer_sizes: list[tuple],
+              directory: str, workers: int = None):
+    train_dataset = share_dataset(train_path, directory, 'train')
+    test_dataset = share_dataset(test_path, directory, 'test')
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=setup_worker_process,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        detector_futures = {
+            features_count: executor.submit(evaluate_detector, train_dataset, test_dataset, features_count)
+            for features_count in features_counts
+        }
+        classifier_futures = {
+            sizes: executor.submit(evaluate_classifier, train_dataset, test_dataset, sizes)
+            for sizes in hidden_layer_sizes
+        }
+
+        detector_results = {key: future.result() for key, future in detector_futures.items()}
+        classifier_results = {key: future.result() for key, future in classifier_futures.items()}
+
+    # Detector and classifier do not depend on each other, so each is evaluated once and the grid is their product.
+    # The name column keeps the stage (untrained, trained or test) every detector result row was measured at.
+    frames = []
+    for features_count, sizes in itertools.product(features_counts, hidden_layer_sizes or [None]):
+        result, _ = detector_results[features_count]
+        frames.append(result.rename_axis('name').reset_index().assign(
+            features_count=features_count,
+            classifier_hidden_layer_sizes=','.join(map(str, sizes)) if sizes else None,
+            classifier_label_accuracy=classifier_results[sizes] if sizes else np.nan,
+        ))
+
+    return (pd.concat(frames, ignore_index=True),
+            {key: detector_data for key, (_, detector_data) in detector_results.items()})
+
+
+def promote(toolset: Toolset, detector_data: bytes):
+    toolset.detector = detector_data
+    toolset.save()
@@ -1,3 +1,923 @@
-from django.test import TestCase
+import io
+import sys
+import time
+import socket
+import pickle
+import hashlib
+import subprocess
+import tempfile
+import json
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from .anomaly_sink import AnomalySink, _RECORD_HEADER
+from .array_codec import encode_array, encode_rows, decode_array, decode_rows, decode_row_groups, is_encoded
+from .exports import filter_anomalies, paginate_anomalies, encode_cursor
+from .models import Toolset, Anomaly, AnomalyClass, AnomalyRollup, RollupPeriod, TrainingJob, TrainingJobStatus
+from .retention import ScoreStats, rollup_toolset, purge_toolset, summarize
+from .jobs import fail_orphaned_job, get_worker_name
+from .toolset_pool import ActiveToolset, ToolsetPool, estimate_size
+from .binary_io import (ARRAY_CONTENT_TYPE, NPY_CONTENT_TYPE, ARROW_CONTENT_TYPE, decode_request_array,
+                        encode_response_array, get_accepted_content_type)
+from .anomaly_stats import get_anomaly_stats
+from . import anomaly_stats, binary_io, blob_storage, metrics, toolset_pool
 
-# Create your tests here.
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def create_toolset(name: str, features_count: int = 3) -> Toolset:
+    from mtehis.model import LearningDetector
+    return Toolset.objects.create(name=name, detector=pickle.dumps(LearningDetector(features_count).get_data()))
+
+
+class ArrayCodecTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        for dtype in (np.float32, np.float64, np.int8, np.int32, np.int64):
+            for shape in ((), (5,), (3, 4), (0, 4)):
+                array = np.arange(int(np.prod(shape)), dtype=dtype).reshape(shape)
+                data = encode_array(array, dtype)
+                self.assertTrue(is_encoded(data))
+                decoded = decode_array(data)
+                self.assertEqual(decoded.dtype, np.dtype(dtype))
+                np.testing.assert_array_equal(decoded, array)
+
+    def test_unsupported_dtype(self):
+        with self.assertRaises(ValueError):
+            encode_array([1, 2], np.float16)
+
+    def test_legacy_pickled_rows(self):
+        data = pickle.dumps([0.5, 1.5, 2.5])
+        self.assertFalse(is_encoded(data))
+        np.testing.assert_array_equal(decode_array(data), [0.5, 1.5, 2.5])
+        np.testing.assert_array_equal(decode_rows([data, encode_array([3.5, 4.5, 5.5])]),
+                                      [[0.5, 1.5, 2.5], [3.5, 4.5, 5.5]])
+
+    def test_empty_values(self):
+        self.assertIsNone(decode_array(None))
+        self.assertIsNone(decode_array(b''))
+        self.assertEqual(decode_rows([]).shape, (0, 0))
+
+    def test_decode_rows(self):
+        matrix = np.random.default_rng(0).random((4, 3))
+        rows = encode_rows(matrix)
+        self.assertEqual(len(rows), 4)
+        np.testing.assert_array_equal(decode_rows(rows), matrix)
+
+        # Rows of another dtype have another header and are decoded one by one
+        mixed = rows[:2] + encode_rows(matrix[2:], np.float32)
+        decoded = decode_rows(mixed)
+        self.assertEqual(decoded.shape, (4, 3))
+        np.testing.assert_allclose(decoded, matrix, rtol=1e-6)
+
+    def test_decode_row_groups(self):
+        values = encode_rows(np.ones((2, 3))) + [b''] + encode_rows(np.zeros((2, 5)))
+        groups = {len(rows[0]): (selected.tolist(), rows) for selected, rows in decode_row_groups(values)}
+        self.assertEqual(groups[3][0], [0, 1])
+        self.assertEqual(groups[5][0], [3, 4])
+        np.testing.assert_array_equal(groups[5][1], np.zeros((2, 5)))
+
+    def test_invalid_bodies(self):
+        data = encode_array(np.ones((2, 3)))
+        bodies = [
+            data[:6],
+            data[:10],
+            data[:-1],
+            data + b'\0' * 8,
+            data[:3] + bytes([2]) + data[4:],
+            data[:4] + b'Z' + data[5:],
+        ]
+        for body in bodies:
+            with self.assertRaises(ValueError):
+                decode_array(body)
+
+
+class RecordingWriter:
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def __call__(self, rows: list):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError('Database unavailable')
+            self.rows.extend(rows)
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.rows)
+
+
+class AnomalySinkTests(SimpleTestCase):
+
+    def create_sink(self, writer, **kwargs) -> AnomalySink:
+        options = {'max_rows': 1000, 'flush_rows': 100, 'flush_interval': 0.05, **kwargs}
+        sink = AnomalySink(writer, **options)
+        self.addCleanup(sink.close)
+        return sink
+
+    def test_interval_flush(self):
+        writer = RecordingWriter()
+        sink = self.create_sink(writer)
+
+        self.assertTrue(sink.put([1, 2, 3]))
+        self.assertTrue(wait_for(lambda: writer.count() == 3))
+
+        # Rows queued after the first flush are flushed by the interval as well
+        self.assertTrue(sink.put([4, 5]))
+        self.assertTrue(wait_for(lambda: writer.count() == 5))
+        self.assertEqual(writer.rows, [1, 2, 3, 4, 5])
+        self.assertEqual(sink.get_stats()['queued_rows'], 0)
+
+    def test_size_flush(self):
+        writer = RecordingWriter()
+        sink = self.create_sink(writer, flush_rows=4, flush_interval=60)
+
+        sink.put([1, 2])
+        time.sleep(0.1)
+        self.assertEqual(writer.count(), 0)
+
+        sink.put([3, 4])
+        self.assertTrue(wait_for(lambda: writer.count() == 4))
+
+    def test_retry_after_failure(self):
+        writer = RecordingWriter(failures=2)
+        sink = self.create_sink(writer)
+
+        with self.assertLogs('mtehis_web.anomaly_sink', 'ERROR'):
+            sink.put([1, 2])
+            self.assertTrue(wait_for(lambda: writer.count() == 2))
+        stats = sink.get_stats()
+        self.assertEqual(stats['failed_flushes'], 2)
+        self.assertEqual(stats['flushed_rows'], 2)
+
+    def test_overflow(self):
+        writer = RecordingWriter()
+        sink = self.create_sink(writer, max_rows=3, flush_interval=60)
+
+        self.assertTrue(sink.put([1, 2]))
+        self.assertFalse(sink.put([3, 4]))
+        self.assertEqual(sink.get_stats()['overflows'], 1)
+
+    def test_close_flushes_pending_rows(self):
+        writer = RecordingWriter()
+        sink = AnomalySink(writer, max_rows=1000, flush_rows=100, flush_interval=60)
+
+        sink.put([1, 2])
+        sink.close()
+        self.assertEqual(writer.rows, [1, 2])
+        self.assertFalse(sink.put([3]))
+
+    def test_journal_replay(self):
+        directory = Path(tempfile.mkdtemp())
+        # Journal of a crashed process, its last record was cut short
+        with open(directory / '1-1.journal', 'wb') as f:
+            for rows in ([1, 2], [3]):
+                record = pickle.dumps(rows)
+                f.write(_RECORD_HEADER.pack(len(record)) + record)
+            record = pickle.dumps([4])
+            f.write(_RECORD_HEADER.pack(len(record)) + record[:-1])
+
+        writer = RecordingWriter()
+        with self.assertLogs('mtehis_web.anomaly_sink', 'WARNING'):
+            self.create_sink(writer, journal_directory=directory)
+        self.assertEqual(writer.rows, [1, 2, 3])
+        self.assertEqual(list(directory.glob('*.journal')), [])
+
+    def test_journal_removed_after_flush(self):
+        directory = Path(tempfile.mkdtemp())
+        writer = RecordingWriter()
+        sink = self.create_sink(writer, journal_directory=directory)
+
+        sink.put([1, 2])
+        self.assertTrue(wait_for(lambda: writer.count() == 2))
+        self.assertTrue(wait_for(lambda: not list(directory.glob('*.journal'))))
+
+
+class AnomalyPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.toolset = Toolset.objects.create(name='pagination', detector=b'')
+        other = Toolset.objects.create(name='other', detector=b'')
+        now = timezone.now()
+        rows = encode_rows(np.arange(21, dtype=np.float64).reshape(7, 3))
+        # Two groups of anomalies created in the same instant, only the id orders them
+        second = timedelta(seconds=1)
+        created_at = [now, now, now, now - second, now - second, now - 2 * second, now]
+        Anomaly.objects.bulk_create([
+            Anomaly(toolset=cls.toolset, inputs=row, detector_scores=row, created_at=created_at[i])
+            for i, row in enumerate(rows)
+        ])
+        Anomaly.objects.create(toolset=other, inputs=rows[0], detector_scores=rows[0], created_at=now)
+
+    def paginate(self, limit: int) -> list[list[dict]]:
+        anomalies = filter_anomalies('pagination')
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = paginate_anomalies(anomalies, limit, cursor)
+            pages.append(page)
+            if cursor is None:
+                return pages
+
+    def test_pages_cover_every_anomaly_once(self):
+        expected = list(Anomaly.objects.filter(toolset=self.toolset).order_by('-created_at', '-id')
+                        .values_list('id', flat=True))
+        for limit in (1, 2, 3, 7, 10):
+            pages = self.paginate(limit)
+            ids = [item['id'] for page in pages for item in page]
+            self.assertEqual(ids, expected, f'limit {limit}')
+            self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+
+    def test_decoded_arrays(self):
+        page, _ = paginate_anomalies(filter_anomalies('pagination'), 10)
+        self.assertEqual(len(page), 7)
+        self.assertTrue(all(len(item['inputs']) == 3 for item in page))
+
+    def test_last_page_has_no_cursor(self):
+        page, cursor = paginate_anomalies(filter_anomalies('pagination'), 7)
+        self.assertEqual(len(page), 7)
+        self.assertIsNone(cursor)
+
+    def test_cursor_of_equal_created_at(self):
+        first = filter_anomalies('pagination').values('id', 'created_at')[0]
+        page, _ = paginate_anomalies(filter_anomalies('pagination'), 10, encode_cursor(first))
+        self.assertEqual(len(page), 6)
+        self.assertNotIn(first['id'], [item['id'] for item in page])
+
+    def test_invalid_arguments(self):
+        anomalies = filter_anomalies('pagination')
+        with self.assertRaises(ValueError):
+            paginate_anomalies(anomalies, 0)
+        with self.assertRaises(ValueError):
+            paginate_anomalies(anomalies, 2, 'not a cursor')
+
+    def test_unknown_toolset(self):
+        self.assertEqual(paginate_anomalies(filter_anomalies('missing'), 5), ([], None))
+
+
+class MetricsTests(TestCase):
+
+    def test_unknown_toolsets_create_no_series(self):
+        for i in range(5):
+            data_file = SimpleUploadedFile('data.csv', b'a,b,c\n0.1,0.2,0.3\n', content_type='text/csv')
+            response = self.client.post('/anomalies/detect/csv', {'toolset': f'made-up-{i}', 'data': data_file})
+            self.assertEqual(response.status_code, 404)
+            response = self.client.post('/anomalies/detect', json.dumps({'toolset': f'made-up-{i}', 'data': [[0.1]]}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertNotIn('made-up', response.content.decode())
+        self.assertIn('endpoint="detect_anomalies_csv",method="POST",status="404"', response.content.decode())
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter('test_total', 'Test counter', ('kind',)))
+        histogram = registry.register(metrics.Histogram('test_seconds', 'Test histogram', buckets=[0.1, 1]))
+        counter.inc(kind='a "quoted"\nvalue')
+        counter.inc(2, kind='b')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = registry.render().splitlines()
+        self.assertIn('test_total{kind="a \\"quoted\\"\\nvalue"} 1', lines)
+        self.assertIn('test_total{kind="b"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count 3', lines)
+
+
+@override_settings(TOOLSET_POOL_MAX_ENTRIES=None, TOOLSET_POOL_MAX_BYTES=None, TOOLSET_SHARED_CACHE_DIR=None)
+class ToolsetPoolTests(TransactionTestCase):
+
+    def setUp(self):
+        ToolsetPool.flush()
+        self.addCleanup(ToolsetPool.flush)
+        for name in ('a', 'b', 'c'):
+            create_toolset(name)
+
+    def names(self) -> list[str]:
+        with ToolsetPool.lock:
+            return list(ToolsetPool.fetch().keys())
+
+    def test_concurrent_loads_construct_once(self):
+        release = threading.Event()
+        constructed = []
+
+        class SlowToolset(ActiveToolset):
+            def __init__(self, toolset):
+                constructed.append(toolset.name)
+                if toolset.name == 'a':
+                    release.wait(5)
+                super().__init__(toolset)
+
+        results = []
+
+        def _load():
+            try:
+                results.append(ToolsetPool.get_or_load_toolset('a'))
+            finally:
+                connection.close()
+
+        with mock.patch.object(toolset_pool, 'ActiveToolset', SlowToolset):
+            threads = [threading.Thread(target=_load) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(wait_for(lambda: 'a' in constructed))
+
+            # Loading another toolset does not wait for the slow one
+            ToolsetPool.get_or_load_toolset('b')
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(sorted(constructed), ['a', 'b'])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(toolset is results[0] for toolset in results))
+
+    @override_settings(TOOLSET_POOL_MAX_ENTRIES=2)
+    def test_least_recently_used_evicted(self):
+        ToolsetPool.get_or_load_toolset('a')
+        ToolsetPool.get_or_load_toolset('b')
+        ToolsetPool.get_or_load_toolset('a')
+        ToolsetPool.get_or_load_toolset('c')
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.assertEqual(ToolsetPool.size(), sum(toolset.size for toolset in ToolsetPool.fetch().values()))
+
+    @override_settings(TOOLSET_POOL_MAX_ENTRIES=1)
+    def test_pinned_toolset_kept(self):
+        with ToolsetPool.get_or_load_toolset('a').pinned():
+            ToolsetPool.get_or_load_toolset('b')
+            self.assertEqual(self.names(), ['a', 'b'])
+
+        ToolsetPool.get_or_load_toolset('c')
+        self.assertEqual(self.names(), ['c'])
+
+    def test_byte_bound(self):
+        size = ToolsetPool.get_or_load_toolset('a').size
+        self.assertGreater(size, 0)
+
+        with override_settings(TOOLSET_POOL_MAX_BYTES=int(size * 1.5)):
+            ToolsetPool.get_or_load_toolset('b')
+            self.assertEqual(self.names(), ['b'])
+            self.assertEqual(ToolsetPool.size(), ToolsetPool.fetch()['b'].size)
+
+        # A toolset growing past the bound pushes out the older ones once its size is refreshed
+        ToolsetPool.get_or_load_toolset('c')
+        toolset = ToolsetPool.get_or_load_toolset('b')
+        toolset.detector.window = np.ones(size)
+        with override_settings(TOOLSET_POOL_MAX_BYTES=toolset.estimate_size() + 1):
+            ToolsetPool.update_size(toolset)
+            self.assertEqual(self.names(), ['b'])
+        self.assertEqual(ToolsetPool.size(), toolset.size)
+        self.assertGreater(toolset.size, size * 8)
+
+
+    def test_readiness_during_background_preload(self):
+        self.addCleanup(setattr, ToolsetPool, '_preload_names', None)
+        self.assertTrue(ToolsetPool.readiness()['ready'])
+
+        release = threading.Event()
+        preload = ToolsetPool.preload
+
+        def _slow_preload(names):
+            release.wait(5)
+            return preload(names)
+
+        with mock.patch.object(ToolsetPool, 'preload', side_effect=_slow_preload):
+            thread = ToolsetPool.preload_in_background(['a', 'missing'])
+            self.assertFalse(ToolsetPool.readiness()['ready'])
+            self.assertEqual(self.client.get('/anomalies/ready').status_code, 503)
+            with self.assertLogs('mtehis_web.toolset_pool', 'ERROR'):
+                release.set()
+                thread.join(5)
+
+        self.assertEqual(ToolsetPool.readiness(), {'ready': True, 'loaded': ['a'], 'pending': ['missing']})
+
+
+class EstimateSizeTests(SimpleTestCase):
+
+    def test_arrays(self):
+        array = np.ones(1000)
+        self.assertGreaterEqual(estimate_size(array), array.nbytes)
+        # Views do not own their buffer, arrays referenced twice are counted once
+        self.assertLess(estimate_size(array[:500]), 500)
+        self.assertLess(estimate_size([array, array]), 2 * array.nbytes)
+
+    def test_objects(self):
+        class Holder:
+            def __init__(self):
+                self.values = {'weights': np.zeros(1000)}
+                self.method = self.__init__
+
+        self.assertGreater(estimate_size(Holder()), 8000)
+        self.assertGreater(estimate_size((Holder(), Holder())), 16000)
+
+
+def create_dataset_file(name: str = 'train.csv', rows: int = 20) -> SimpleUploadedFile:
+    values = np.random.default_rng(0).random((rows, 3))
+    lines = ['timestamp,a,b,c,label'] + [f'{i},{a},{b},{c},{int(i % 5 == 0)}' for i, (a, b, c) in enumerate(values)]
+    return SimpleUploadedFile(name, '\n'.join(lines).encode(), content_type='text/csv')
+
+
+def get_dead_worker_name() -> str:
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return f'{socket.gethostname()}:{process.pid}'
+
+
+class TrainingJobTests(TransactionTestCase):
+
+    def setUp(self):
+        ToolsetPool.flush()
+        self.addCleanup(ToolsetPool.flush)
+        upload_directory = tempfile.mkdtemp()
+        self.settings_override = override_settings(TRAINING_UPLOAD_DIR=upload_directory,
+                                                   TRAINING_JOB_EVENTS_POLL_INTERVAL=0.01)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.upload_directory = Path(upload_directory)
+        self.toolset = create_toolset('training')
+        self.client.force_login(User.objects.create_user('trainer'))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch('mtehis_web.jobs.get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_job(self, job_id: int) -> dict:
+        return self.client.get('/anomalies/train', {'job': job_id}).json()
+
+    def wait_for_job(self, job_id: int) -> dict:
+        # Polling meanwhile could hit the table locks of the shared in-memory test database
+        self.executor.shutdown(wait=True)
+        return self.get_job(job_id)
+
+    def test_job_finishes(self):
+        response = self.client.post('/anomalies/train', {'toolset': 'training', 'train_ds': create_dataset_file(),
+                                                         'test_ds': create_dataset_file('test.csv')})
+        job = self.wait_for_job(response.json()['job'])
+
+        self.assertEqual(job['evaluation'], 'finished', job['error'])
+        self.assertIsNotNone(job['result'])
+        self.assertIsNotNone(job['finished_at'])
+        self.assertEqual(list(self.upload_directory.iterdir()), [])
+        response = self.client.get('/anomalies/train', {'toolset': 'training'})
+        self.assertEqual(response.json()['job'], job['job'])
+
+    def test_job_fails(self):
+        with mock.patch('mtehis_web.jobs.read_dataset', side_effect=ValueError('Unreadable dataset')), \
+                self.assertLogs('mtehis_web.jobs', 'ERROR'):
+            response = self.client.post('/anomalies/train', {'toolset': 'training', 'train_ds': create_dataset_file()})
+            job = self.wait_for_job(response.json()['job'])
+
+        self.assertEqual(job['evaluation'], 'failed')
+        self.assertIn('Unreadable dataset', job['error'])
+        self.assertEqual(list(self.upload_directory.iterdir()), [])
+        # The toolset is released for later jobs and evictions
+        self.assertFalse(ToolsetPool.get_or_load_toolset('training').is_pinned)
+
+    def test_invalid_requests(self):
+        response = self.client.post('/anomalies/train', {'toolset': 'training'})
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertFalse(TrainingJob.objects.exists())
+
+        response = self.client.post('/anomalies/train', {'toolset': 'missing', 'train_ds': create_dataset_file()})
+        self.assertEqual(response.status_code, 404)
+
+        for path in ('/anomalies/train', '/anomalies/train/events'):
+            for job_id in ('abc', '', '-1', '1.5'):
+                response = self.client.get(path, {'job': job_id})
+                self.assertEqual(response.json()['status'], 'error', f'{path} {job_id!r}')
+            self.assertEqual(self.client.get(path, {'job': 999}).status_code, 404)
+
+    def test_fail_orphaned_job(self):
+        train_file = self.upload_directory / 'train.csv'
+        train_file.write_text('a,b,c\n')
+        orphaned = TrainingJob.objects.create(toolset=self.toolset, worker=get_dead_worker_name(),
+                                              train_file=str(train_file))
+        remote = TrainingJob.objects.create(toolset=self.toolset, worker='other-host:1')
+        finished = TrainingJob.objects.create(toolset=self.toolset, worker=get_dead_worker_name(),
+                                              status=TrainingJobStatus.finished)
+
+        with self.assertLogs('mtehis_web.jobs', 'WARNING'):
+            self.assertTrue(fail_orphaned_job(orphaned))
+        self.assertFalse(fail_orphaned_job(remote))
+        self.assertFalse(fail_orphaned_job(finished))
+        self.assertFalse(train_file.exists())
+
+        orphaned.refresh_from_db()
+        self.assertEqual(orphaned.status, TrainingJobStatus.failed)
+        self.assertIn('exited', orphaned.error)
+        self.assertEqual(self.get_job(remote.id)['evaluation'], 'queued')
+
+    def read_events(self, job_id: int) -> list[dict]:
+        response = self.client.get('/anomalies/train/events', {'job': job_id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode()
+        return [json.loads(line[len('data: '):]) for line in content.split('\n\n') if line]
+
+    def test_events_end_with_job(self):
+        job = TrainingJob.objects.create(toolset=self.toolset, status=TrainingJobStatus.finished)
+        events = self.read_events(job.id)
+        self.assertEqual([event['evaluation'] for event in events], ['finished'])
+
+        # Jobs of exited workers are failed by the stream instead of keeping it open
+        with self.assertLogs('mtehis_web.jobs', 'WARNING'):
+            events = self.read_events(TrainingJob.objects.create(toolset=self.toolset,
+                                                                 worker=get_dead_worker_name()).id)
+        self.assertEqual([event['evaluation'] for event in events], ['failed'])
+
+    @override_settings(TRAINING_JOB_EVENTS_MAX_DURATION=0.05)
+    def test_events_end_after_max_duration(self):
+        job = TrainingJob.objects.create(toolset=self.toolset, worker=get_worker_name())
+        events = self.read_events(job.id)
+        self.assertEqual([event['evaluation'] for event in events], ['queued'])
+
+
+@override_settings(ANOMALY_ROLLUP_DELAY=300, ANOMALY_RETENTION_DAYS=None)
+class RetentionTests(TestCase):
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.toolset = Toolset.objects.create(name='retention', detector=b'')
+        cls.label = AnomalyClass.objects.create(name='spike')
+
+    def add(self, offset: timedelta, scores: list, label: AnomalyClass = None):
+        row = encode_array(scores)
+        Anomaly.objects.create(toolset=self.toolset, inputs=row, detector_scores=row, label=label,
+                               created_at=self.start + offset)
+
+    def test_rollup(self):
+        self.add(timedelta(minutes=10), [1, 2, 3])
+        self.add(timedelta(minutes=20), [3, 4, 5])
+        self.add(timedelta(hours=1, minutes=5), [5, 5, 5], self.label)
+        self.add(timedelta(days=1), [0, 0, 0])
+        # Not rolled up yet, the sinks may still be writing anomalies of the current hour
+        self.add(timedelta(days=1, hours=23, minutes=58), [9, 9, 9])
+
+        self.assertEqual(rollup_toolset(self.toolset, now=self.start + timedelta(days=1, hours=23, minutes=59,
+                                                                                 seconds=59), batch_size=2), 4)
+        self.assertEqual(self.toolset.rollup_watermark, self.start + timedelta(days=1, hours=23))
+
+        hours = summarize('retention', 'hour')
+        self.assertEqual([(item['period_start'], item['label'], item['count']) for item in hours], [
+            (self.start, None, 2),
+            (self.start + timedelta(hours=1), 'spike', 1),
+            (self.start + timedelta(days=1), None, 1),
+        ])
+        self.assertEqual(hours[0]['detector_score_mean'], [2, 3, 4])
+        self.assertEqual(hours[0]['detector_score_std'], [1, 1, 1])
+        self.assertEqual(hours[0]['detector_score_min'], [1, 2, 3])
+        self.assertEqual(hours[0]['detector_score_max'], [3, 4, 5])
+
+        days = summarize('retention', 'day')
+        self.assertEqual([(item['period_start'], item['label'], item['count']) for item in days], [
+            (self.start, None, 2),
+            (self.start, 'spike', 1),
+            (self.start + timedelta(days=1), None, 1),
+        ])
+        with self.assertRaises(ValueError):
+            summarize('retention', 'week')
+
+    def test_watermark_advance(self):
+        self.add(timedelta(minutes=10), [1, 1, 1])
+        self.assertEqual(rollup_toolset(self.toolset, now=self.start + timedelta(hours=2)), 1)
+        self.assertEqual(rollup_toolset(self.toolset, now=self.start + timedelta(hours=2)), 0)
+
+        # Only anomalies past the watermark are read, the day is aggregated again from all of its hours
+        self.add(timedelta(hours=2, minutes=30), [3, 3, 3])
+        self.assertEqual(rollup_toolset(self.toolset, now=self.start + timedelta(hours=4)), 1)
+        self.assertEqual(self.toolset.rollup_watermark, self.start + timedelta(hours=3))
+        self.assertEqual([item['count'] for item in summarize('retention', 'hour')], [1, 1])
+        days = summarize('retention', 'day')
+        self.assertEqual([item['count'] for item in days], [2])
+        self.assertEqual(days[0]['detector_score_mean'], [2, 2, 2])
+        self.assertEqual(AnomalyRollup.objects.filter(period=RollupPeriod.day).count(), 1)
+
+    def test_mixed_widths(self):
+        self.add(timedelta(minutes=10), [1, 1, 1])
+        self.add(timedelta(minutes=20), [3, 3, 3])
+        self.add(timedelta(minutes=30), [7, 7, 7, 7, 7])
+        rollup_toolset(self.toolset, now=self.start + timedelta(hours=2))
+
+        hour, = summarize('retention', 'hour')
+        self.assertEqual(hour['count'], 2)
+        self.assertEqual(hour['detector_score_mean'], [2, 2, 2])
+
+        wide = ScoreStats(3, np.full(5, 6.0), np.full(5, 12.0), np.ones(5), np.full(5, 3.0))
+        narrow = ScoreStats(1, np.ones(3), np.ones(3), np.ones(3), np.ones(3))
+        for merged in (wide.merge(narrow), narrow.merge(wide)):
+            self.assertEqual(merged.to_dict()['count'], 3)
+            self.assertEqual(merged.to_dict()['detector_score_mean'], [2] * 5)
+
+    def test_purge_limited_by_watermark(self):
+        for day in range(4):
+            self.add(timedelta(days=day), [1, 1, 1])
+        self.toolset.retention_days = 1
+        self.assertEqual(purge_toolset(self.toolset, now=self.start + timedelta(days=10)), 0)
+
+        rollup_toolset(self.toolset, now=self.start + timedelta(days=2, hours=1))
+        # Anomalies past the retention period but not rolled up yet are kept
+        self.assertEqual(purge_toolset(self.toolset, now=self.start + timedelta(days=10)), 2)
+        self.assertEqual(Anomaly.objects.filter(toolset=self.toolset).count(), 2)
+        self.assertEqual(sum(item['count'] for item in summarize('retention', 'day')), 2)
+
+        rollup_toolset(self.toolset, now=self.start + timedelta(days=10))
+        archive_directory = tempfile.mkdtemp()
+        self.assertEqual(purge_toolset(self.toolset, now=self.start + timedelta(days=10),
+                                       archive_directory=archive_directory), 2)
+        self.assertFalse(Anomaly.objects.filter(toolset=self.toolset).exists())
+        self.assertEqual(sum(item['count'] for item in summarize('retention', 'day')), 4)
+        self.assertEqual(len(list(Path(archive_directory).glob('retention-*.ndjson.gz'))), 1)
+
+
+class BlobStorageTests(TestCase):
+
+    def setUp(self):
+        self.data = blob_storage.serialize({'weights': np.arange(100.0)})
+
+    def test_plain_pickle(self):
+        self.assertEqual(blob_storage.store(self.data), self.data)
+        self.assertFalse(blob_storage.is_stored(self.data))
+        self.assertEqual(blob_storage.load(self.data), self.data)
+        self.assertEqual(blob_storage.load(b''), b'')
+
+    def test_inline_round_trip(self):
+        modules = {'zstd': blob_storage.zstandard, 'lz4': blob_storage.lz4}
+        for compression in ('zstd', 'lz4'):
+            with self.subTest(compression=compression), override_settings(TOOLSET_BLOB_COMPRESSION=compression):
+                if modules[compression] is None:
+                    self.skipTest(f'{compression} is not installed')
+                stored = blob_storage.store(self.data)
+                self.assertTrue(blob_storage.is_stored(stored))
+                self.assertEqual(blob_storage.get_checksum(stored), hashlib.sha256(self.data).hexdigest())
+                self.assertEqual(blob_storage.load(stored), self.data)
+
+        with override_settings(TOOLSET_BLOB_COMPRESSION='gzip'), self.assertRaises(ValueError):
+            blob_storage.store(self.data)
+
+    def test_file_round_trip(self):
+        directory = Path(tempfile.mkdtemp())
+        with override_settings(TOOLSET_BLOB_DIR=str(directory)):
+            stored = blob_storage.store(self.data)
+            # Only the reference is kept in the value, identical content shares its file
+            self.assertEqual(blob_storage.store(self.data), stored)
+            self.assertLess(len(stored), 64)
+            self.assertEqual(len(list(directory.glob('*/*'))), 1)
+            self.assertEqual(blob_storage.load(stored), self.data)
+            self.assertEqual(blob_storage.get_checksum(stored), blob_storage.get_checksum(self.data))
+
+        with self.assertRaises(ValueError):
+            blob_storage.load(stored)
+
+    def test_toolset_models(self):
+        from mtehis.model import LearningDetector
+        from sklearn.neural_network import MLPClassifier
+        with override_settings(TOOLSET_BLOB_DIR=tempfile.mkdtemp()):
+            toolset = Toolset(name='blobs')
+            toolset.set_detector(LearningDetector(4).get_data())
+            toolset.set_classifier(MLPClassifier(hidden_layer_sizes=(8, 4)))
+            toolset.save()
+
+            toolset = Toolset.objects.get(name='blobs')
+            self.assertEqual(blob_storage.loads(toolset.detector).features_count, 4)
+            self.assertEqual(blob_storage.loads(toolset.classifier).hidden_layer_sizes, (8, 4))
+            self.assertEqual(toolset.detector_features_count, 4)
+            self.assertEqual(toolset.classifier_layer_sizes, '8,4')
+            self.assertEqual(toolset.detector_size, len(blob_storage.load(toolset.detector)))
+
+            # Plain pickles assigned directly are stored on save
+            toolset.detector = pickle.dumps(LearningDetector(5).get_data())
+            toolset.save()
+            toolset.refresh_from_db()
+            self.assertTrue(blob_storage.is_stored(toolset.detector))
+            self.assertEqual(toolset.detector_features_count, 5)
+
+    def test_unchanged_classifier_not_rewritten(self):
+        from sklearn.neural_network import MLPClassifier
+        classifier = MLPClassifier(hidden_layer_sizes=(8,))
+        toolset = Toolset(name='unchanged', detector=b'')
+        toolset.set_classifier(classifier)
+        toolset.save()
+
+        toolset = Toolset.objects.defer('detector', 'classifier').get(name='unchanged')
+        with mock.patch.object(blob_storage, 'store') as store, CaptureQueriesContext(connection) as queries:
+            toolset.set_classifier(classifier)
+            toolset.save()
+        store.assert_not_called()
+        update, = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertNotIn('"classifier"', update)
+        self.assertEqual(Toolset.objects.get(name='unchanged').revision, 2)
+
+    def test_prune_model_blobs(self):
+        from mtehis.model import LearningDetector
+        directory = Path(tempfile.mkdtemp())
+        with override_settings(TOOLSET_BLOB_DIR=str(directory)):
+            toolset = Toolset(name='pruned')
+            toolset.set_detector(LearningDetector(3).get_data())
+            toolset.save()
+            blob_storage.store(self.data)
+            self.assertEqual(len(list(directory.glob('*/*'))), 2)
+
+            # Fresh files may belong to saves that are not committed yet
+            call_command('prune_model_blobs', stdout=io.StringIO())
+            self.assertEqual(len(list(directory.glob('*/*'))), 2)
+
+            call_command('prune_model_blobs', '--min-age', '0', stdout=io.StringIO())
+            paths = list(directory.glob('*/*'))
+            self.assertEqual([path.name for path in paths], [toolset.detector_checksum])
+            self.assertEqual(blob_storage.loads(Toolset.objects.get(name='pruned').detector).features_count, 3)
+
+
+def encode_npy(array: np.ndarray) -> bytes:
+    stream = io.BytesIO()
+    np.lib.format.write_array(stream, array)
+    return stream.getvalue()
+
+
+class BinaryIOTests(TestCase):
+
+    def setUp(self):
+        self.matrix = np.random.default_rng(0).random((4, 3))
+
+    def test_npy_round_trip(self):
+        for dtype in (np.float32, np.float64):
+            decoded = decode_request_array(NPY_CONTENT_TYPE, encode_npy(self.matrix.astype(dtype)))
+            self.assertEqual(decoded.dtype, np.dtype(dtype))
+            np.testing.assert_array_equal(decoded, self.matrix.astype(dtype))
+        # Fortran ordered arrays keep their layout
+        fortran = encode_npy(np.asfortranarray(self.matrix))
+        np.testing.assert_array_equal(decode_request_array(NPY_CONTENT_TYPE, fortran), self.matrix)
+
+        result = np.array([0, 1, 1, 0], dtype=np.int8)
+        stream = io.BytesIO(encode_response_array(NPY_CONTENT_TYPE, result))
+        np.testing.assert_array_equal(np.lib.format.read_array(stream), result)
+
+    def test_array_round_trip(self):
+        np.testing.assert_array_equal(decode_request_array(ARRAY_CONTENT_TYPE, encode_array(self.matrix)), self.matrix)
+        result = np.array([0, 1], dtype=np.int8)
+        np.testing.assert_array_equal(decode_array(encode_response_array(ARRAY_CONTENT_TYPE, result)), result)
+
+    def test_arrow_round_trip(self):
+        if binary_io.pa is None:
+            self.skipTest('pyarrow is not installed')
+        pa = binary_io.pa
+        table = pa.table({f'f{i}': self.matrix[:, i] for i in range(3)})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        np.testing.assert_array_equal(decode_request_array(ARROW_CONTENT_TYPE, sink.getvalue().to_pybytes()),
+                                      self.matrix)
+
+        result = np.array([0, 1, 1], dtype=np.int8)
+        body = encode_response_array(ARROW_CONTENT_TYPE, result)
+        np.testing.assert_array_equal(pa.ipc.open_stream(body).read_all().column('result').to_numpy(), result)
+
+    def test_accept_negotiation(self):
+        self.assertIsNone(get_accepted_content_type(''))
+        self.assertIsNone(get_accepted_content_type('application/json, */*'))
+        self.assertEqual(get_accepted_content_type(f'text/html, {NPY_CONTENT_TYPE};q=0.9, {ARRAY_CONTENT_TYPE}'),
+                         NPY_CONTENT_TYPE)
+        if binary_io.pa is None:
+            with self.assertRaises(ValueError):
+                get_accepted_content_type(ARROW_CONTENT_TYPE)
+        else:
+            self.assertEqual(get_accepted_content_type(ARROW_CONTENT_TYPE), ARROW_CONTENT_TYPE)
+
+    def test_invalid_bodies(self):
+        npy = encode_npy(self.matrix)
+        bodies = [
+            (NPY_CONTENT_TYPE, b''),
+            (NPY_CONTENT_TYPE, npy[:5]),
+            (NPY_CONTENT_TYPE, npy[:30]),
+            (NPY_CONTENT_TYPE, npy[:-1]),
+            (NPY_CONTENT_TYPE, npy + b'\0' * 8),
+            (NPY_CONTENT_TYPE, encode_npy(self.matrix.astype(np.int64))),
+            (NPY_CONTENT_TYPE, encode_npy(np.array([[None]], dtype=object))),
+            (NPY_CONTENT_TYPE, encode_npy(self.matrix[0])),
+            (ARRAY_CONTENT_TYPE, pickle.dumps(self.matrix)),
+            (ARRAY_CONTENT_TYPE, encode_array(self.matrix)[:-1]),
+            (ARRAY_CONTENT_TYPE, encode_array(self.matrix.astype(np.int32), np.int32)),
+            (ARRAY_CONTENT_TYPE, encode_array(self.matrix[0])),
+        ]
+        for content_type, body in bodies:
+            with self.subTest(content_type=content_type, size=len(body)), self.assertRaises(ValueError):
+                decode_request_array(content_type, body)
+
+    def test_detect(self):
+        ToolsetPool.flush()
+        self.addCleanup(ToolsetPool.flush)
+        create_toolset('binary')
+        response = self.client.post('/anomalies/detect?toolset=binary', encode_npy(self.matrix),
+                                    content_type=NPY_CONTENT_TYPE, HTTP_ACCEPT=NPY_CONTENT_TYPE)
+        self.assertEqual(response['Content-Type'], NPY_CONTENT_TYPE)
+        result = np.lib.format.read_array(io.BytesIO(response.content))
+        self.assertEqual((result.dtype, result.shape), (np.dtype(np.int8), (4,)))
+
+        response = self.client.post('/anomalies/detect', encode_npy(self.matrix), content_type=NPY_CONTENT_TYPE)
+        self.assertEqual(response.json()['status'], 'error')
+        response = self.client.post('/anomalies/detect?toolset=binary', encode_npy(self.matrix)[:-1],
+                                    content_type=NPY_CONTENT_TYPE)
+        self.assertEqual(response.json()['status'], 'error')
+
+
+@override_settings(ANOMALY_ROLLUP_DELAY=300, ANOMALY_STATS_PERCENTILES=[0, 50, 100])
+class AnomalyStatsTests(TestCase):
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.toolset = Toolset.objects.create(name='stats', detector=b'')
+        cls.label = AnomalyClass.objects.create(name='drift')
+        cls.scores = np.arange(30, dtype=np.float64).reshape(10, 3)
+        Anomaly.objects.bulk_create([
+            Anomaly(toolset=cls.toolset, inputs=row, detector_scores=row, created_at=cls.start + timedelta(minutes=i))
+            for i, row in enumerate(encode_rows(cls.scores))
+        ])
+
+    def setUp(self):
+        anomaly_stats._cache.clear()
+        self.addCleanup(anomaly_stats._cache.clear)
+
+    def get_stats(self, datetime_to: datetime = None) -> dict:
+        return get_anomaly_stats('stats', self.start.isoformat(), datetime_to.isoformat() if datetime_to else None)
+
+    def test_chunked_aggregation(self):
+        expected = self.get_stats()
+        for chunk_size in (1, 3, 7):
+            with override_settings(ANOMALY_EXPORT_CHUNK_SIZE=chunk_size):
+                self.assertEqual(self.get_stats(), expected, f'chunk size {chunk_size}')
+
+        scores = expected['detector_scores']
+        self.assertEqual(expected['count'], 10)
+        self.assertEqual(expected['labels'], {None: 10})
+        self.assertEqual(scores['mean'], self.scores.mean(axis=0).tolist())
+        self.assertEqual(scores['min'], [0, 1, 2])
+        self.assertEqual(scores['max'], [27, 28, 29])
+        self.assertEqual(scores['percentiles']['50'], np.median(self.scores, axis=0).tolist())
+        self.assertEqual((scores['sampled'], scores['skipped']), (10, 0))
+
+    @override_settings(ANOMALY_STATS_SAMPLE_SIZE=4, ANOMALY_EXPORT_CHUNK_SIZE=3)
+    def test_sampling(self):
+        scores = self.get_stats()['detector_scores']
+        # Only the percentiles come from the sample, the other figures cover every row
+        self.assertEqual(scores['sampled'], 4)
+        self.assertEqual(scores['mean'], self.scores.mean(axis=0).tolist())
+        sampled_rows = np.array([scores['percentiles']['0'], scores['percentiles']['100']])
+        self.assertTrue(np.isin(sampled_rows, self.scores).all())
+
+    def test_mixed_widths_skipped(self):
+        row = encode_array(np.ones(5))
+        Anomaly.objects.create(toolset=self.toolset, inputs=row, detector_scores=row, created_at=self.start)
+        scores = self.get_stats()['detector_scores']
+        self.assertEqual(scores['skipped'], 1)
+        self.assertEqual(scores['min'], [0, 1, 2])
+
+    def test_closed_window_cache(self):
+        datetime_to = self.start + timedelta(hours=1)
+        stats = self.get_stats(datetime_to)
+        self.assertIs(self.get_stats(datetime_to), stats)
+        # Open windows may still receive anomalies and are computed every time
+        self.assertIsNot(self.get_stats(), self.get_stats())
+
+        # Labels assigned by hand change the key
+        anomaly = Anomaly.objects.filter(toolset=self.toolset).first()
+        anomaly.label = self.label
+        anomaly.labelled_at = timezone.now()
+        anomaly.save()
+        relabelled = self.get_stats(datetime_to)
+        self.assertEqual(relabelled['labels'], {None: 9, 'drift': 1})
+
+        Anomaly.objects.filter(id=anomaly.id).update(label=None, labelled_at=timezone.now())
+        self.assertEqual(self.get_stats(datetime_to)['labels'], {None: 10})
+
+        with self.assertRaises(Toolset.DoesNotExist):
+            get_anomaly_stats('missing')
+        with self.assertRaises(ValueError):
+            get_anomaly_stats('stats', 'yesterday')
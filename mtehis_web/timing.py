@@ -0,0 +1,21 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started_at)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing_header(self) -> str:
+        return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items())
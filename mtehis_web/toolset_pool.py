@@ -1,74 +1,253 @@
+import sys
+import time
+import types
 import pickle
-import pandas as pd
+import logging
+import threading
 from enum import Enum
 from typing import Optional
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import numpy as np
+from django.conf import settings
+from django.db import connection
 from django.shortcuts import get_object_or_404
 from sklearn.neural_network import MLPClassifier
 from streamad.util import CustomDS
 from mtehis.model import LearningDetector
 from mtehis.data import LearningDetectorData
 from mtehis.util import evaluate
-from .models import Toolset
+from .models import Toolset, AnomalyClassMapping
+from . import shared_model_cache, blob_storage, metrics
+from .micro_batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType)
+
+
+def estimate_size(obj) -> int:
+    # Walks the object graph once. Arrays count the buffers they own, views on shared cache files only their header.
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if item is None or id(item) in seen or isinstance(item, _SKIPPED_TYPES):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, np.ndarray):
+            continue
+
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        if hasattr(item, '__dict__'):
+            stack.append(item.__dict__)
+        for slot in getattr(type(item), '__slots__', ()):
+            stack.append(getattr(item, slot, None))
+    return size
 
 
 class EvaluationStatus(str, Enum):
     not_started = 'not started'
     processing = 'processing'
     finished = 'finished'
+    failed = 'failed'
 
 
 class EvaluationInfo:
-    def __init__(self, train_ds: CustomDS = None, test_ds: CustomDS = None):
+    def __init__(self, train_ds: CustomDS = None, test_ds: CustomDS = None, progress_func=None):
         self.train_ds = train_ds
         self.test_ds = test_ds
+        self.progress_func = progress_func
         self.status = EvaluationStatus.not_started
         self.iteration = 0
-        self.result: Optional[pd.DataFrame] = None
+        # Only the JSON summary of the evaluation frame is kept while the toolset stays pooled
+        self.result: Optional[str] = None
 
     def start_evaluation(self, detector: LearningDetector, classifier: MLPClassifier = None):
         def _logging_func(i):
             self.iteration = i
+            if self.progress_func is not None:
+                self.progress_func(i)
 
         detector.logging_func = _logging_func
 
         self.status = EvaluationStatus.processing
 
-        self.result = evaluate(detector, self.train_ds, self.test_ds)
+        try:
+            result = evaluate(detector, self.train_ds, self.test_ds)
+        except Exception:
+            self.status = EvaluationStatus.failed
+            raise
+        finally:
+            # Datasets are released as soon as the evaluation is over
+            self.train_ds = None
+            self.test_ds = None
+
+        self.result = result.to_json() if result is not None else None
 
         # TODO: classifier
 
         self.status = EvaluationStatus.finished
 
-        return self.result
+        return result
+
+
+class Detection:
+    def __init__(self, predicted, scores, classifier_scores=None, labels: list = None):
+        self.predicted = predicted
+        self.scores = scores
+        self.anomalies_mask = predicted == 1
+        # Classifier results only cover the rows flagged by the detector
+        self.classifier_scores = classifier_scores
+        self.labels = labels
 
 
 class ActiveToolset:
     def __init__(self, toolset: Toolset):
         self.id = toolset.id
-        detector_data: LearningDetectorData = pickle.loads(toolset.detector)
+        self.name = toolset.name
+        self.revision = toolset.revision
+        self.checked_at = time.monotonic()
+        detector_data: LearningDetectorData = self._load_model(toolset, 'detector')
         self.detector = LearningDetector.create_from_data(detector_data)
 
-        if toolset.classifier and len(toolset.classifier) > 0:
-            self.classifier: MLPClassifier = pickle.loads(toolset.classifier)
-        else:
-            self.classifier = None
+        self.classifier: Optional[MLPClassifier] = self._load_model(toolset, 'classifier')
+
+        # The live detectors are much larger than their serialized data and their windows grow with the rows they
+        # see, so the pool refreshes this estimate when it checks the revision
+        self.size = estimate_size((self.detector, self.classifier))
 
         self.evaluation_info: Optional[EvaluationInfo] = None
+        self._pins = 0
+        self._class_mapping: Optional[dict[int, int]] = None
+        self._class_mapping_loaded_at = 0
+        # The detector learns while predicting, so concurrent requests must not interleave inside it
+        self.lock = threading.Lock()
+
+        window = getattr(settings, 'DETECT_MICRO_BATCH_WINDOW', 0)
+        if window > 0:
+            max_rows = getattr(settings, 'DETECT_MICRO_BATCH_MAX_ROWS', 10000)
+            self.batcher: Optional[MicroBatcher] = MicroBatcher(self._predict_with_scores, window, max_rows)
+        else:
+            self.batcher = None
+
+    @staticmethod
+    def _load_model(toolset: Toolset, field: str):
+        path = shared_model_cache.get_path(toolset.id, toolset.revision, field)
+        if path is not None:
+            try:
+                return shared_model_cache.attach(path)
+            except FileNotFoundError:
+                pass
+
+        # Binary fields are deferred when the shared cache is enabled and only fetched on a cache miss
+        data = blob_storage.load(getattr(toolset, field))
+        model = pickle.loads(data) if data else None
+
+        if path is None:
+            return model
+
+        # Attaching to the published file lets this worker share the pages with the others as well
+        shared_model_cache.publish(path, model)
+        return shared_model_cache.attach(path)
+
+    def estimate_size(self) -> int:
+        with self.lock:
+            return estimate_size((self.detector, self.classifier))
+
+    def predict_with_scores(self, input_data):
+        if self.batcher is not None:
+            return self.batcher.predict_with_scores(input_data)
+        return self._predict_with_scores(input_data)
+
+    def _predict_with_scores(self, input_data):
+        with self.lock:
+            return self.detector.predict_with_scores(input_data)
+
+    def get_class_mapping(self) -> dict[int, int]:
+        ttl = getattr(settings, 'TOOLSET_CLASS_MAPPING_TTL', 60)
+        if self._class_mapping is None or time.monotonic() - self._class_mapping_loaded_at > ttl:
+            self._class_mapping = dict(
+                AnomalyClassMapping.objects.filter(toolset_id=self.id).values_list('index', 'anomaly_class_id')
+            )
+            self._class_mapping_loaded_at = time.monotonic()
+        return self._class_mapping
+
+    def invalidate_class_mapping(self):
+        self._class_mapping = None
+
+    def classify(self, inputs):
+        # A classifier created in the admin is not usable until it has been fitted
+        if self.classifier is None or not hasattr(self.classifier, 'classes_') or len(inputs) == 0:
+            return None, None
+
+        classifier_scores = self.classifier.predict_proba(inputs)
+        indices = self.classifier.classes_[classifier_scores.argmax(axis=1)]
+
+        class_mapping = self.get_class_mapping()
+        labels = [class_mapping.get(int(index)) for index in indices]
+
+        return classifier_scores, labels
+
+    def detect(self, input_data) -> Detection:
+        predicted, scores = self.predict_with_scores(input_data)
+        detection = Detection(predicted, scores)
+        detection.classifier_scores, detection.labels = self.classify(input_data[detection.anomalies_mask])
+        return detection
+
+    @property
+    def is_pinned(self):
+        evaluating = self.evaluation_info is not None and self.evaluation_info.status == EvaluationStatus.processing
+        return evaluating or self._pins > 0
+
+    @contextmanager
+    def pinned(self):
+        with ToolsetPool.lock:
+            self._pins += 1
+        try:
+            yield self
+        finally:
+            with ToolsetPool.lock:
+                self._pins -= 1
 
     def save(self):
-        toolset = Toolset.objects.get(id=self.id)
-        toolset.detector = pickle.dumps(self.detector.get_data())
+        toolset = Toolset.objects.defer('detector', 'classifier').get(id=self.id)
+        with self.lock:
+            detector_data = self.detector.get_data()
+        toolset.set_detector(detector_data)
         if self.classifier:
-            toolset.classifier = pickle.dumps(self.classifier)
+            toolset.set_classifier(self.classifier)
         toolset.save()
+        # The saved state is already loaded, so the new revision must not trigger a reload
+        self.revision = toolset.revision
+
+    def start_evaluation(self, train_ds: CustomDS = None, test_ds: CustomDS = None, save_results=False,
+                         progress_func=None):
+        with ToolsetPool.lock:
+            if self.evaluation_info is not None and self.evaluation_info.status == EvaluationStatus.processing:
+                raise RuntimeError('Toolset is already being evaluated')
 
-    def start_evaluation(self, train_ds: CustomDS = None, test_ds: CustomDS = None, save_results=False):
-        if self.evaluation_info is not None and self.evaluation_info.status == EvaluationStatus.processing:
-            raise RuntimeError('Toolset is already being evaluated')
+            self.evaluation_info = EvaluationInfo(train_ds, test_ds, progress_func)
+            self.evaluation_info.status = EvaluationStatus.processing
 
-        self.evaluation_info = EvaluationInfo(train_ds, test_ds)
+        # A copy is trained so detect requests keep using the current detector without waiting for the evaluation,
+        # what the current one learns from them in the meantime is replaced by the trained copy
+        with self.lock:
+            detector_data = self.detector.get_data()
+        detector = LearningDetector.create_from_data(detector_data)
 
-        result = self.evaluation_info.start_evaluation(self.detector, self.classifier)
+        result = self.evaluation_info.start_evaluation(detector, self.classifier)
+
+        with self.lock:
+            self.detector = detector
+        ToolsetPool.update_size(self)
 
         if save_results:
             self.save()
@@ -77,7 +256,14 @@ class ActiveToolset:
 
 
 class ToolsetPool:
-    _toolsets: dict[str, ActiveToolset] = {}
+    _toolsets: OrderedDict[str, ActiveToolset] = OrderedDict()
+    _load_locks: dict[str, threading.Lock] = {}
+    _reloading: set[str] = set()
+    _preload_names: Optional[list[str]] = None
+    _preload_finished = False
+    _size = 0
+    lock = threading.RLock()
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'reloads': 0}
 
     @classmethod
     def fetch(cls):
@@ -85,10 +271,243 @@ class ToolsetPool:
 
     @classmethod
     def flush(cls):
-        cls._toolsets = {}
+        with cls.lock:
+            cls._toolsets = OrderedDict()
+            cls._size = 0
+
+    @classmethod
+    def size(cls):
+        return cls._size
+
+    @classmethod
+    def collect_metrics(cls):
+        with cls.lock:
+            for event, value in cls.stats.items():
+                metrics.POOL_EVENTS.set_total(value, event=event)
+            metrics.POOL_ENTRIES.set(len(cls._toolsets))
+            metrics.POOL_BYTES.set(cls._size)
 
     @classmethod
     def get_or_load_toolset(cls, name: str):
-        if name not in cls._toolsets:
-            cls._toolsets[name] = ActiveToolset(get_object_or_404(Toolset, name=name))
-        return cls._toolsets[name]
+        with cls.lock:
+            toolset = cls._get(name)
+        if toolset is not None:
+            return cls._check_revision(name, toolset)
+
+        with cls.lock:
+            load_lock = cls._load_locks.setdefault(name, threading.Lock())
+
+        # Only one thread deserializes a given toolset, the others wait for it and reuse the result
+        with load_lock:
+            with cls.lock:
+                toolset = cls._get(name)
+                if toolset is not None:
+                    return toolset
+                cls.stats['misses'] += 1
+
+            try:
+                started_at = time.perf_counter()
+                toolset = ActiveToolset(get_object_or_404(cls._toolsets_queryset(), name=name))
+                metrics.TOOLSET_LOAD_SECONDS.observe(time.perf_counter() - started_at, toolset=name)
+            finally:
+                with cls.lock:
+                    if cls._load_locks.get(name) is load_lock:
+                        del cls._load_locks[name]
+
+            with cls.lock:
+                cls._put(name, toolset)
+
+        return toolset
+
+    @classmethod
+    def get_preload_names(cls, names: list[str] = None) -> list[str]:
+        names = getattr(settings, 'TOOLSET_PRELOAD', []) if names is None else names
+        if names == '__all__':
+            return list(Toolset.objects.values_list('name', flat=True))
+        return list(names)
+
+    @classmethod
+    def preload(cls, names: list[str] = None):
+        cls._preload_finished = False
+        cls._preload_names = []
+        loaded = []
+        try:
+            cls._preload_names = cls.get_preload_names(names)
+            for name in cls._preload_names:
+                started_at = time.perf_counter()
+                try:
+                    cls.get_or_load_toolset(name)
+                except Exception:
+                    logger.exception('Failed to preload toolset %s', name)
+                    continue
+                loaded.append(name)
+                logger.info('Preloaded toolset %s in %.2f s', name, time.perf_counter() - started_at)
+        finally:
+            cls._preload_finished = True
+        return loaded
+
+    @classmethod
+    def preload_in_background(cls, names: list[str] = None):
+        # Set before the thread starts, so readiness never reports a preload that has not begun as finished
+        cls._preload_finished = False
+        cls._preload_names = []
+
+        def _preload():
+            try:
+                cls.preload(names)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=_preload, name='toolset-preload', daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def preload_on_startup(cls):
+        # Called by the WSGI and ASGI entry points only, management commands and spawned workers never preload
+        if not getattr(settings, 'TOOLSET_PRELOAD_ON_STARTUP', False):
+            return
+
+        if getattr(settings, 'TOOLSET_PRELOAD_IN_BACKGROUND', True):
+            cls.preload_in_background()
+        else:
+            cls.preload()
+
+    @classmethod
+    def readiness(cls) -> dict:
+        names = cls._preload_names or []
+        with cls.lock:
+            loaded = [name for name in names if name in cls._toolsets]
+        return {
+            # Nothing to wait for when preloading is not configured
+            'ready': cls._preload_names is None or cls._preload_finished,
+            'loaded': loaded,
+            'pending': [name for name in names if name not in loaded],
+        }
+
+    @classmethod
+    def remove(cls, name: str):
+        with cls.lock:
+            toolset = cls._toolsets.pop(name, None)
+            if toolset is not None:
+                cls._size -= toolset.size
+            return toolset
+
+    @classmethod
+    def invalidate(cls, name: str):
+        # The next request for the toolset compares its revision with the database
+        with cls.lock:
+            toolset = cls._toolsets.get(name)
+            if toolset is not None:
+                toolset.checked_at = float('-inf')
+
+    @classmethod
+    def invalidate_class_mapping(cls, toolset_id: int):
+        with cls.lock:
+            for toolset in cls._toolsets.values():
+                if toolset.id == toolset_id:
+                    toolset.invalidate_class_mapping()
+
+    @classmethod
+    def reload_in_background(cls, name: str):
+        with cls.lock:
+            if name in cls._reloading:
+                return
+            cls._reloading.add(name)
+
+        threading.Thread(target=cls._reload, args=(name,), name=f'toolset-reload-{name}', daemon=True).start()
+
+    @classmethod
+    def _toolsets_queryset(cls):
+        if shared_model_cache.get_cache_directory() is not None:
+            return Toolset.objects.defer('detector', 'classifier')
+        return Toolset.objects.all()
+
+    @classmethod
+    def _check_revision(cls, name: str, toolset: ActiveToolset):
+        interval = getattr(settings, 'TOOLSET_POOL_REVISION_CHECK_INTERVAL', 5)
+        now = time.monotonic()
+        if interval is None or now - toolset.checked_at < interval:
+            return toolset
+        toolset.checked_at = now
+
+        revision = Toolset.objects.filter(name=name).values_list('revision', flat=True).first()
+        if revision is None:
+            cls.remove(name)
+            return cls.get_or_load_toolset(name)
+        if revision != toolset.revision:
+            # The stale toolset keeps serving requests until the new revision is loaded
+            cls.reload_in_background(name)
+        cls.update_size(toolset)
+
+        return toolset
+
+    @classmethod
+    def update_size(cls, toolset: ActiveToolset):
+        size = toolset.estimate_size()
+        with cls.lock:
+            if cls._toolsets.get(toolset.name) is toolset:
+                cls._size += size - toolset.size
+                toolset.size = size
+                cls._evict()
+            else:
+                toolset.size = size
+
+    @classmethod
+    def _reload(cls, name: str):
+        try:
+            started_at = time.perf_counter()
+            toolset = ActiveToolset(cls._toolsets_queryset().get(name=name))
+            metrics.TOOLSET_LOAD_SECONDS.observe(time.perf_counter() - started_at, toolset=name)
+            with cls.lock:
+                current = cls._toolsets.get(name)
+                # A pinned toolset is replaced by a later check once it is released
+                if current is not None and not current.is_pinned and current.revision != toolset.revision:
+                    cls._put(name, toolset)
+                    cls.stats['reloads'] += 1
+        except Toolset.DoesNotExist:
+            cls.remove(name)
+        finally:
+            with cls.lock:
+                cls._reloading.discard(name)
+            connection.close()
+
+    @classmethod
+    def _get(cls, name: str):
+        toolset = cls._toolsets.get(name)
+        if toolset is not None:
+            cls._toolsets.move_to_end(name)
+            cls.stats['hits'] += 1
+        return toolset
+
+    @classmethod
+    def _put(cls, name: str, toolset: ActiveToolset):
+        previous = cls._toolsets.pop(name, None)
+        if previous is not None:
+            cls._size -= previous.size
+
+        cls._toolsets[name] = toolset
+        cls._size += toolset.size
+        cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        max_entries = getattr(settings, 'TOOLSET_POOL_MAX_ENTRIES', None)
+        max_size = getattr(settings, 'TOOLSET_POOL_MAX_BYTES', None)
+
+        def _is_full():
+            return ((max_entries is not None and len(cls._toolsets) > max_entries)
+                    or (max_size is not None and cls._size > max_size))
+
+        # Least recently used toolsets go first, the most recent one and pinned ones are never evicted
+        for name in list(cls._toolsets.keys())[:-1]:
+            if not _is_full():
+                break
+            toolset = cls._toolsets[name]
+            if not toolset.is_pinned:
+                del cls._toolsets[name]
+                cls._size -= toolset.size
+                cls.stats['evictions'] += 1
+
+
+metrics.registry.collectors.append(ToolsetPool.collect_metrics)
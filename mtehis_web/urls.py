@@ -1,7 +1,14 @@
 from django.urls import path
-from .views import detect_anomalies, train
+from .views import (detect_anomalies, detect_anomalies_async, detect_anomalies_csv, train, train_events, ready,
+                    anomaly_summary, anomaly_stats)
 
 urlpatterns = [
     path('detect', detect_anomalies, name='detect_anomalies'),
+    path('detect/async', detect_anomalies_async, name='detect_anomalies_async'),
+    path('detect/csv', detect_anomalies_csv, name='detect_anomalies_csv'),
     path('train', train, name='train'),
+    path('train/events', train_events, name='train_events'),
+    path('summary', anomaly_summary, name='anomaly_summary'),
+    path('stats', anomaly_stats, name='anomaly_stats'),
+    path('ready', ready, name='ready'),
 ]
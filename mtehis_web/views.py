@@ -1,68 +1,104 @@
 import json
-import pickle
+import time
+import asyncio
 import numpy as np
 import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import StreamingHttpResponse
-from streamad.util import CustomDS
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from .toolset_pool import ToolsetPool
-from .models import Anomaly
+from .models import Toolset, TrainingJob, TrainingJobStatus
+from .jobs import enqueue_training_job, fail_orphaned_job, serialize_job
+from .datasets import prepare_df, get_features
+from .inference import InferenceBusy, get_inference_executor, predict
+from .timing import StageTimer
+from .metrics import get_stage_timer, get_endpoint, observe_stages, observe_detection
+from .binary_io import BINARY_CONTENT_TYPES, decode_request_array, encode_response_array, get_accepted_content_type
+from .anomaly_store import persist_detection
+from .exports import (EXPORT_FIELDS, STREAMING_CONTENT_TYPES, filter_anomalies, decode_anomaly, paginate_anomalies,
+                      streaming_export_response, get_page_max_limit)
+from .retention import summarize
+from .anomaly_stats import get_anomaly_stats
+
+
+def _parse_detect_request(request):
+    response_content_type = get_accepted_content_type(request.headers.get('Accept', ''))
+
+    if request.content_type in BINARY_CONTENT_TYPES:
+        toolset_name = request.GET.get('toolset') or request.headers.get('X-Toolset')
+        if not toolset_name:
+            raise ValueError('Binary requests must pass the toolset name in the "toolset" query parameter '
+                             'or X-Toolset header')
+        return toolset_name, decode_request_array(request.content_type, request.body), response_content_type
+
+    data = json.loads(request.body)
+
+    if 'toolset' not in data or 'data' not in data:
+        raise ValueError('Request body must have "toolset" and "data" fields')
+
+    return data.get('toolset'), np.array(data.get('data'), dtype=np.float64), response_content_type
+
+
+def _detect_response(content_type, predicted):
+    if content_type is not None:
+        return HttpResponse(encode_response_array(content_type, predicted.astype(np.int8)), content_type=content_type)
+
+    return JsonResponse({'status': 'success', 'result': predicted.tolist()})
 
 
 @csrf_exempt
 def detect_anomalies(request):
     if request.method == 'POST':
-        data = json.loads(request.body)
+        timer = get_stage_timer(request)
 
-        if 'toolset' not in data or 'data' not in data:
-            return JsonResponse({'status': 'error', 'message': 'Request body must have "toolset" and "data" fields'})
+        with timer.stage('parse'):
+            try:
+                toolset_name, input_data, response_content_type = _parse_detect_request(request)
+            except ValueError as e:
+                return JsonResponse({'status': 'error', 'message': str(e)})
 
-        toolset = ToolsetPool.get_or_load_toolset(data.get('toolset'))
-        input_data = np.array(data.get('data'), dtype=np.float64)
+        with timer.stage('load'):
+            toolset = ToolsetPool.get_or_load_toolset(toolset_name)
 
-        predicted, scores = toolset.detector.predict_with_scores(input_data)
+        with timer.stage('predict'):
+            detection = toolset.detect(input_data)
 
-        # TODO: classifier
+        with timer.stage('persist'):
+            anomalies_count = persist_detection(toolset.id, input_data, detection)
 
-        inputs_with_anomalies = input_data[predicted == 1]
-        detector_scores_with_anomalies = scores[predicted == 1]
+        observe_detection(request, toolset_name, len(input_data), anomalies_count)
 
-        anomalies_count = len(inputs_with_anomalies)
-        for i in range(anomalies_count):
-            inputs = inputs_with_anomalies[i].tolist()
-            detector_scores = detector_scores_with_anomalies[i].tolist()
-            Anomaly.objects.create(
-                toolset_id=toolset.id,
-                inputs=pickle.dumps(inputs),
-                detector_scores=pickle.dumps(detector_scores),
-                label=None,
-            )
+        with timer.stage('serialize'):
+            response = _detect_response(response_content_type, detection.predicted)
 
-        return JsonResponse({'status': 'success', 'result': predicted.tolist()})
+        response['Server-Timing'] = timer.server_timing_header()
+        return response
 
     elif request.method == 'GET':
-        toolset_name = request.GET.get('toolset')
-        datetime_from = request.GET.get('from', None)
-        datetime_to = request.GET.get('to', None)
-
-        query_filter = {'toolset__name': toolset_name}
-        if datetime_from is not None:
-            query_filter['created_at__gte'] = datetime_from
-        if datetime_to is not None:
-            query_filter['created_at__lte'] = datetime_to
-
-        anomalies = Anomaly.objects.filter(**query_filter)
-
-        result = list(anomalies.values())
-        for item in result:
-            item['inputs'] = pickle.loads(item['inputs'])
-            item['detector_scores'] = pickle.loads(item['detector_scores'])
-            if item['classifier_scores'] is not None and len(item['classifier_scores']) > 0:
-                item['classifier_scores'] = pickle.loads(item['classifier_scores'])
-            else:
-                item['classifier_scores'] = None
+        anomalies = filter_anomalies(request.GET.get('toolset'), request.GET.get('from'), request.GET.get('to'))
+        export_format = request.GET.get('format', 'json')
+
+        if export_format in STREAMING_CONTENT_TYPES:
+            try:
+                return streaming_export_response(anomalies, export_format)
+            except ImportError as e:
+                return JsonResponse({'status': 'error', 'message': str(e)})
+
+        if 'limit' in request.GET or 'cursor' in request.GET:
+            try:
+                limit = int(request.GET.get('limit', get_page_max_limit()))
+                result, next_cursor = paginate_anomalies(anomalies, limit, request.GET.get('cursor'))
+            except ValueError as e:
+                return JsonResponse({'status': 'error', 'message': str(e)})
+
+            return JsonResponse({'status': 'success', 'result': result, 'next_cursor': next_cursor})
+
+        result = [decode_anomaly(item) for item in anomalies.values(*EXPORT_FIELDS)]
 
         return JsonResponse({'status': 'success', 'result': result})
 
@@ -70,74 +106,178 @@ def detect_anomalies(request):
         return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
 
+async def detect_anomalies_async(request):
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+
+    timer = get_stage_timer(request)
+
+    with timer.stage('parse'):
+        try:
+            toolset_name, input_data, response_content_type = _parse_detect_request(request)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)})
+
+    started_at = time.perf_counter()
+    try:
+        future = get_inference_executor(toolset_name).submit(predict, toolset_name, input_data)
+    except InferenceBusy as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=429)
+
+    toolset_id, detection, worker_timings = await asyncio.wrap_future(future)
+    for stage, seconds in worker_timings.items():
+        timer.add(stage, seconds)
+    timer.add('queue', max(0.0, time.perf_counter() - started_at - sum(worker_timings.values())))
+
+    with timer.stage('persist'):
+        anomalies_count = await sync_to_async(persist_detection)(toolset_id, input_data, detection)
+
+    observe_detection(request, toolset_name, len(input_data), anomalies_count)
+
+    with timer.stage('serialize'):
+        response = _detect_response(response_content_type, detection.predicted)
+
+    response['Server-Timing'] = timer.server_timing_header()
+    return response
+
+
+# csrf_exempt only learned to wrap coroutine functions in Django 5.0
+detect_anomalies_async.csrf_exempt = True
+
+
 @csrf_exempt
-@login_required
-def train(request):
-    if request.method == 'POST':
-        train_file = request.FILES.get('train_ds', None)
-        test_file = request.FILES.get('test_ds', None)
-        toolset_name = request.POST.get('toolset')
-        print_text = request.POST.get('print_text', False)
-
-        train_df = pd.read_csv(train_file) if train_file else None
-        test_df = pd.read_csv(test_file) if test_file else None
-
-        def prepare_df(df: pd.DataFrame):
-            if 'timestamp' in df.columns:
-                df.set_index('timestamp')
-                df.sort_values('timestamp')
-            elif 'id' in df.columns:
-                df.set_index('id')
-            return df
-
-        if train_df is not None:
-            prepare_df(train_df)
-        if test_df is not None:
-            prepare_df(test_df)
-
-        def update_generator():
-            # noinspection PyTypeChecker
-            train_dataset = CustomDS(train_df) if train_df is not None else None
-            # noinspection PyTypeChecker
-            test_dataset = CustomDS(test_df) if test_df is not None else None
+def detect_anomalies_csv(request):
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
-            toolset = ToolsetPool.get_or_load_toolset(toolset_name)
+    data_file = request.FILES.get('data', None)
+    toolset_name = request.POST.get('toolset')
+    if data_file is None or not toolset_name:
+        return JsonResponse({'status': 'error', 'message': 'Request must have "toolset" field and "data" file'})
 
-            if print_text:
-                yield 'Training started.\n'
+    with get_stage_timer(request).stage('load'):
+        toolset = ToolsetPool.get_or_load_toolset(toolset_name)
+    # Only names of existing toolsets become label values, so requests cannot grow the metrics without bound
+    request.metrics_toolset = toolset_name
+    chunk_size = getattr(settings, 'DETECT_CSV_CHUNK_SIZE', 10000)
+    endpoint = get_endpoint(request)
 
-            result = toolset.start_evaluation(train_dataset, test_dataset, save_results=True)
+    def result_generator():
+        for i, chunk in enumerate(pd.read_csv(data_file, chunksize=chunk_size)):
+            # Chunks are processed after the middleware returned, so they are observed here
+            timer = StageTimer()
+            with timer.stage('parse'):
+                input_data = get_features(prepare_df(chunk))
 
-            if print_text:
-                yield 'Detector data was saved.\n'
+            with timer.stage('predict'):
+                detection = toolset.detect(input_data)
 
-            yield result.to_json()
+            with timer.stage('persist'):
+                anomalies_count = persist_detection(toolset.id, input_data, detection)
 
-            detector_data = toolset.detector.get_data()
+            observe_stages(endpoint, toolset_name, timer)
+            observe_detection(request, toolset_name, len(input_data), anomalies_count)
 
-            yield detector_data.__repr__()
+            yield json.dumps({
+                'chunk': i,
+                'rows': len(input_data),
+                'anomalies': anomalies_count,
+                'result': detection.predicted.tolist(),
+            }) + '\n'
 
-            # TODO: classifier
+    return StreamingHttpResponse(result_generator(), status=200, content_type='application/x-ndjson')
 
-            if print_text:
-                yield 'Processing complete.\n'
 
-        response = StreamingHttpResponse(update_generator(), status=200, content_type='text/event-stream')
-        response['Cache-Control'] = 'no-cache'
-        return response
+def _parse_job_id(value: str):
+    return int(value) if value and value.isdecimal() else None
 
-    elif request.method == 'GET':
-        toolset_name = request.GET.get('toolset')
-        ts = ToolsetPool.get_or_load_toolset(toolset_name)
 
-        if ts.evaluation_info is None:
+@csrf_exempt
+@login_required
+def train(request):
+    if request.method == 'POST':
+        train_file = request.FILES.get('train_ds', None)
+        test_file = request.FILES.get('test_ds', None)
+        if train_file is None and test_file is None:
+            return JsonResponse({'status': 'error', 'message': 'Request must have a train_ds or test_ds file'})
+        toolset = get_object_or_404(Toolset.objects.only('id', 'name'), name=request.POST.get('toolset'))
+
+        request.metrics_toolset = toolset.name
+        with get_stage_timer(request).stage('spool'):
+            job = enqueue_training_job(toolset, train_file, test_file)
+
+        return JsonResponse({'status': 'success', 'job': job.id})
+
+    elif request.method == 'GET':
+        if 'job' in request.GET:
+            job_id = _parse_job_id(request.GET.get('job'))
+            if job_id is None:
+                return JsonResponse({'status': 'error', 'message': 'Invalid job id'})
+            job = get_object_or_404(TrainingJob.objects.select_related('toolset'), id=job_id)
+        else:
+            job = TrainingJob.objects.select_related('toolset').filter(toolset__name=request.GET.get('toolset')).first()
+
+        if job is None:
             return JsonResponse({'status': 'success', 'result': 'Training data not provided'})
 
-        return JsonResponse({
-            'status': 'success',
-            'iteration': ts.evaluation_info.iteration,
-            'evaluation': ts.evaluation_info.status,
-            'result': ts.evaluation_info.result.to_json() if ts.evaluation_info.result is not None else None,
-        })
+        fail_orphaned_job(job)
+        return JsonResponse({'status': 'success', **serialize_job(job)})
     else:
         return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+
+
+@login_required
+def train_events(request):
+    job_id = _parse_job_id(request.GET.get('job'))
+    if job_id is None:
+        return JsonResponse({'status': 'error', 'message': 'Invalid job id'})
+    get_object_or_404(TrainingJob, id=job_id)
+    poll_interval = getattr(settings, 'TRAINING_JOB_EVENTS_POLL_INTERVAL', 1)
+    max_duration = getattr(settings, 'TRAINING_JOB_EVENTS_MAX_DURATION', 600)
+
+    def event_generator():
+        last_event = None
+        # The stream holds a server thread, clients reconnect after it ends and get the current state again
+        deadline = time.monotonic() + max_duration
+        while True:
+            job = TrainingJob.objects.select_related('toolset').get(id=job_id)
+            fail_orphaned_job(job)
+            event = json.dumps(serialize_job(job), cls=DjangoJSONEncoder)
+            if event != last_event:
+                last_event = event
+                yield f'data: {event}\n\n'
+            if job.status in (TrainingJobStatus.finished, TrainingJobStatus.failed) or time.monotonic() >= deadline:
+                break
+            time.sleep(poll_interval)
+
+    response = StreamingHttpResponse(event_generator(), status=200, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def anomaly_summary(request):
+    try:
+        result = summarize(request.GET.get('toolset'), request.GET.get('period', 'hour'), request.GET.get('from'),
+                           request.GET.get('to'))
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)})
+
+    rolled_up_until = Toolset.objects.filter(name=request.GET.get('toolset')).values_list('rollup_watermark',
+                                                                                         flat=True).first()
+    return JsonResponse({'status': 'success', 'result': result, 'rolled_up_until': rolled_up_until})
+
+
+def anomaly_stats(request):
+    try:
+        stats = get_anomaly_stats(request.GET.get('toolset'), request.GET.get('from'), request.GET.get('to'))
+    except Toolset.DoesNotExist:
+        return JsonResponse({'status': 'error', 'message': 'Toolset not found'}, status=404)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)})
+
+    return JsonResponse({'status': 'success', **stats})
+
+
+def ready(request):
+    readiness = ToolsetPool.readiness()
+    return JsonResponse({'status': 'success', **readiness}, status=200 if readiness['ready'] else 503)
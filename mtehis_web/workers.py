@@ -0,0 +1,9 @@
+import os
+
+
+# Kept free of model imports: spawned workers unpickle the initializer before Django is set up
+def setup_worker_process():
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+    django.setup()
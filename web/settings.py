@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+import django
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -41,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "mtehis_web.metrics.metrics_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -75,12 +78,38 @@ WSGI_APPLICATION = "web.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# MTEHIS_DB_PROFILE selects "sqlite" (default) or "postgresql", MTEHIS_DB_* variables override the connection
+DATABASE_PROFILE = os.environ.get("MTEHIS_DB_PROFILE", "sqlite")
+
+if DATABASE_PROFILE == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("MTEHIS_DB_NAME", "mtehis"),
+            "USER": os.environ.get("MTEHIS_DB_USER", ""),
+            "PASSWORD": os.environ.get("MTEHIS_DB_PASSWORD", ""),
+            "HOST": os.environ.get("MTEHIS_DB_HOST", ""),
+            "PORT": os.environ.get("MTEHIS_DB_PORT", ""),
+            "CONN_MAX_AGE": int(os.environ.get("MTEHIS_DB_CONN_MAX_AGE", 60)),
+            "CONN_HEALTH_CHECKS": True,
+        }
     }
-}
+elif DATABASE_PROFILE == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get("MTEHIS_DB_NAME", BASE_DIR / "db.sqlite3"),
+            "OPTIONS": {},
+            "CONN_MAX_AGE": int(os.environ.get("MTEHIS_DB_CONN_MAX_AGE", 60)),
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+    if django.VERSION >= (5, 1):
+        # Writers take the lock when the transaction begins, so a read-then-write transaction waits for the lock
+        # instead of failing when another connection wrote in between
+        DATABASES["default"]["OPTIONS"]["transaction_mode"] = "IMMEDIATE"
+else:
+    raise ValueError(f"Unknown database profile: {DATABASE_PROFILE}")
 
 
 # Password validation
@@ -123,3 +152,116 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# MT-EHIS
+
+# Maximum number of anomalies written by a single INSERT statement
+ANOMALY_BULK_CREATE_BATCH_SIZE = 500
+
+# Element type used to store anomaly inputs and scores ('float64' or 'float32')
+ANOMALY_ARRAY_DTYPE = 'float64'
+
+# Rows fetched per database round trip by the streaming anomaly export
+ANOMALY_EXPORT_CHUNK_SIZE = 2000
+
+# Largest page size accepted by the paginated anomaly listing
+ANOMALY_PAGE_MAX_LIMIT = 10000
+
+# Rows per row group (record batch) of the Parquet and Arrow anomaly exports
+ANOMALY_EXPORT_ROW_GROUP_SIZE = 50000
+
+# Detected anomalies are buffered and written by a background thread instead of within the detect request. They show
+# up in queries only after the flush, a full buffer falls back to writing in the request.
+ANOMALY_WRITE_BEHIND = False
+ANOMALY_WRITE_BEHIND_MAX_ROWS = 100000
+# A flush starts once this many rows are buffered or the oldest buffered row waited this many seconds
+ANOMALY_WRITE_BEHIND_FLUSH_ROWS = 5000
+ANOMALY_WRITE_BEHIND_FLUSH_INTERVAL = 1
+# Directory of journals replayed after a crash (None keeps buffered rows only in memory), fsync protects against
+# host crashes at the cost of a sync per request
+ANOMALY_WRITE_BEHIND_JOURNAL_DIR = None
+ANOMALY_WRITE_BEHIND_JOURNAL_FSYNC = False
+
+# PRAGMAs run on every new SQLite connection: write-ahead log so readers do not block the writer, fewer fsyncs
+# (safe with WAL), milliseconds to wait for the write lock before "database is locked" and memory mapped reads
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 20000,
+    'mmap_size': 256 * 2 ** 20,
+}
+
+# Days raw anomalies are kept when their toolset does not set its own retention (None keeps them forever)
+ANOMALY_RETENTION_DAYS = None
+# Anomalies rolled up, archived or deleted at a time by the apply_retention command
+ANOMALY_RETENTION_BATCH_SIZE = 5000
+# Seconds after the end of an hour before its anomalies are rolled up, covers rows still buffered by write-behind
+ANOMALY_ROLLUP_DELAY = 300
+
+# Percentiles of the anomaly statistics endpoint, computed on a uniform sample of at most this many anomalies
+ANOMALY_STATS_PERCENTILES = [50, 90, 99]
+ANOMALY_STATS_SAMPLE_SIZE = 100000
+# Statistics of windows that ended more than ANOMALY_ROLLUP_DELAY ago kept per process
+ANOMALY_STATS_CACHE_SIZE = 128
+
+# Bounds of the per-process cache of loaded toolsets (None disables a bound). Sizes are estimated from the live
+# detectors and classifiers and refreshed every TOOLSET_POOL_REVISION_CHECK_INTERVAL.
+TOOLSET_POOL_MAX_ENTRIES = 16
+TOOLSET_POOL_MAX_BYTES = None
+
+# Seconds between checks of a pooled toolset's revision against the database (None disables the check)
+TOOLSET_POOL_REVISION_CHECK_INTERVAL = 5
+
+# Directory of model files shared by all worker processes on the host (None keeps models private to each worker).
+# Classifier weights are shared, detectors are still built by every worker but skip fetching their blob.
+TOOLSET_SHARED_CACHE_DIR = None
+
+# Toolset names (or '__all__') loaded when a WSGI or ASGI server process starts, see also the warm_toolsets command
+TOOLSET_PRELOAD = []
+TOOLSET_PRELOAD_ON_STARTUP = False
+TOOLSET_PRELOAD_IN_BACKGROUND = True
+
+# Compression of stored detector and classifier blobs: None, 'zstd' or 'lz4' (needs the zstandard or lz4 package)
+TOOLSET_BLOB_COMPRESSION = None
+# Directory for detector and classifier blobs, referenced from the database by content hash (None keeps them inline)
+TOOLSET_BLOB_DIR = None
+
+# Training jobs run in a local pool of 'thread' or 'process' workers
+TRAINING_JOB_EXECUTOR = 'thread'
+TRAINING_JOB_WORKERS = 1
+# Directory for uploaded datasets waiting for their job (None uses the system temporary directory)
+TRAINING_UPLOAD_DIR = None
+# Seconds between progress updates written by a job and between polls of the progress event stream
+TRAINING_JOB_PROGRESS_INTERVAL = 1
+TRAINING_JOB_EVENTS_POLL_INTERVAL = 1
+# Seconds after which the progress event stream ends, clients reconnect to keep following the job
+TRAINING_JOB_EVENTS_MAX_DURATION = 600
+
+# Executor of the asynchronous detect endpoint: 'thread' or 'process' pool, one 'shared' by all toolsets or one per
+# 'toolset'. Process workers keep their own copy of every toolset, so detectors learning online diverge between them.
+DETECT_EXECUTOR = 'thread'
+DETECT_EXECUTOR_SCOPE = 'shared'
+DETECT_EXECUTOR_WORKERS = 4
+# Running and queued predictions per executor before requests are rejected with 429
+DETECT_EXECUTOR_MAX_PENDING = 64
+
+# Concurrent detect requests for the same toolset arriving within this many seconds are predicted together,
+# up to DETECT_MICRO_BATCH_MAX_ROWS rows per prediction (0 disables micro-batching)
+DETECT_MICRO_BATCH_WINDOW = 0
+DETECT_MICRO_BATCH_MAX_ROWS = 10000
+
+# Rows read, predicted and persisted at a time by the CSV detect endpoint
+DETECT_CSV_CHUNK_SIZE = 10000
+
+# Seconds a loaded toolset caches its classifier index to anomaly class mapping
+TOOLSET_CLASS_MAPPING_TTL = 60
+
+# Labelled anomalies fetched, decoded and learned per partial_fit call by the retrain_classifier command
+CLASSIFIER_RETRAINING_BATCH_SIZE = 1000
+
+# Type of feature columns in training datasets, 'float32' halves their memory
+TRAINING_DTYPE = 'float64'
+
+# Record request, stage and toolset pool metrics served in the Prometheus text format at /metrics
+METRICS_ENABLED = True
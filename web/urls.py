@@ -16,8 +16,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from mtehis_web.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('anomalies/', include('mtehis_web.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
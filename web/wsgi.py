@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
 
 application = get_wsgi_application()
+
+from mtehis_web.toolset_pool import ToolsetPool  # noqa: E402
+from mtehis_web.jobs import fail_orphaned_jobs  # noqa: E402
+
+ToolsetPool.preload_on_startup()
+fail_orphaned_jobs()